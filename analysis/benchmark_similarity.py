@@ -0,0 +1,69 @@
+# benchmark_similarity.py
+# 類似フィルターの判定速度を比較する。
+#   - 従来方式: 投稿ごとに報告ベクトルをループして cosine_similarity を計算
+#   - 行列方式: similarity.find_similar_uris で1ページ分を1回の行列積で判定
+import os
+import sys
+import time
+
+import numpy as np
+
+# 親ディレクトリ（ルート）をパスに追加して app モジュールをインポートできるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import similarity
+
+DIM = 768
+PAGE_SIZE = 50                      # /timeline_content の1ページ分
+REPORT_COUNTS = [10, 100, 1000, 5000, 20000]
+THRESHOLD = 0.80
+REPEAT = 5
+
+def cosine_similarity(vec1, vec2):
+    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+
+def loop_filter(uris, embeddings, unpleasant_vectors, threshold):
+    """main.apply_filter_to_post と同じ、投稿ごと・報告ごとのループ"""
+    similar = set()
+    for uri, emb in zip(uris, embeddings):
+        for vec in unpleasant_vectors:
+            if cosine_similarity(emb, vec) > threshold:
+                similar.add(uri)
+                break
+    return similar
+
+def measure(func, *args, repeat=REPEAT):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    rng = np.random.default_rng(0)
+    uris = [f"at://bench/post/{i}" for i in range(PAGE_SIZE)]
+    embeddings = list(rng.standard_normal((PAGE_SIZE, DIM)).astype(np.float32))
+
+    print(f"1ページ {PAGE_SIZE} 件 × 次元数 {DIM} / 閾値 {THRESHOLD} / {REPEAT}回中の最速値")
+    print(f"{'報告数':>8} | {'ループ(ms)':>12} | {'行列積(ms)':>12} | {'高速化':>8}")
+    print("-" * 52)
+    for n_reports in REPORT_COUNTS:
+        reports = rng.standard_normal((n_reports, DIM)).astype(np.float32)
+        # 一部の投稿を報告ベクトルに近づけ、判定結果が空にならないようにする
+        for i in range(0, PAGE_SIZE, 10):
+            embeddings[i] = reports[i % n_reports] + 0.1 * rng.standard_normal(DIM).astype(np.float32)
+
+        normalized = similarity.normalize_rows(reports)
+        vector_time, vector_result = measure(similarity.find_similar_uris, uris, embeddings, normalized, THRESHOLD)
+
+        # ループ方式は報告数が多いと遅すぎるため、回数を減らして計測する
+        loop_reports = list(reports)
+        loop_repeat = REPEAT if n_reports <= 1000 else 1
+        loop_time, loop_result = measure(loop_filter, uris, embeddings, loop_reports, THRESHOLD, repeat=loop_repeat)
+
+        assert loop_result == vector_result, "判定結果が一致しません"
+        print(f"{n_reports:>8} | {loop_time * 1000:>12.2f} | {vector_time * 1000:>12.3f} | {loop_time / vector_time:>7.0f}x")
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,17 @@ def calculate_performance():
         result = cursor.fetchone()
         true_positives = result['count'] if result else 0
 
+        # 4. カテゴリを付けた経路 (LLM / 近傍のラベル / ローカル分類器) ごとのフィルター評価
+        cursor.execute("""
+            SELECT COALESCE(p.label_source, '不明') AS label_source,
+                   COUNT(*) FILTER (WHERE f.feedback = 'correct') AS correct,
+                   COUNT(*) FILTER (WHERE f.feedback = 'incorrect') AS incorrect
+            FROM filter_feedback f
+            LEFT JOIN post_analysis_cache p ON f.post_uri = p.post_uri
+            GROUP BY 1 ORDER BY 1
+        """)
+        by_label_source = cursor.fetchall()
+
         conn.close()
 
         # --- 統計指標の計算 ---
@@ -53,6 +64,15 @@ def calculate_performance():
         else:
             print("\n■ 再現率 (Recall)   : データなし（不快な投稿ゼロ）")
 
+        # 3. 分類経路別の適合率（LLM以外の経路の精度をLLMと比べる）
+        if by_label_source:
+            print("\n■ 分類経路別の適合率")
+            for row in by_label_source:
+                hidden = row['correct'] + row['incorrect']
+                if hidden == 0:
+                    continue
+                print(f"   {row['label_source']:<16}: {row['correct'] / hidden * 100:.1f}% ({row['correct']}/{hidden} 件)")
+
     except Exception as e:
         print(f"エラーが発生しました: {e}")
 
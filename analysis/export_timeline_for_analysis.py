@@ -7,6 +7,7 @@ import sys
 from dotenv import load_dotenv
 from atproto import Client
 import app.llm_analyzer as llm_analyzer
+import app.database as database
 
 # .envファイルから環境変数を読み込む
 load_dotenv(encoding='utf-8')
@@ -17,6 +18,8 @@ BSKY_APP_PASSWORD = os.getenv('BSKY_APP_PASSWORD')
 # 出力ファイル名
 CSV_FILE = "analysis_for_checking_01.csv"
 TXT_FILE = "timeline_analysis_export.txt"
+# True にすると分析結果（カテゴリ＋埋め込み）を post_analysis_cache にまとめて保存する
+SAVE_TO_CACHE = False
 
 # --- ▼▼▼ 設定：文字数分布の目標値 ▼▼▼ ---
 # 各ビンごとの目標収集件数
@@ -246,6 +249,15 @@ def fetch_and_export_timeline():
         print(f"⚠️ {failed_count}件の分析に失敗したため、保存を中止します。")
         return
 
+    if SAVE_TO_CACHE:
+        try:
+            saved = database.save_analysis_results_bulk(
+                zip([info['post_uri'] for info in original_posts_info], llm_results)
+            )
+            print(f"分析結果 {saved} 件を post_analysis_cache に保存しました。")
+        except Exception as e:
+            print(f"⚠️ キャッシュへの保存に失敗しました: {e}")
+
     # データの結合
     final_data = []
     for i, post_info in enumerate(original_posts_info):
@@ -101,6 +101,7 @@ def calculate_and_display_stats(df: pd.DataFrame, group_col: str, title: str, ou
         'followers_count_group': 'フォロワー数',
         'follows_count_group': 'フォロー数',
         'text_length_group': '投稿の文字数',
+        'label_source': '分類経路',
     }
     
     # 総合結果の場合、グループ化は行全体
@@ -223,6 +224,11 @@ def main():
             
         calculate_and_display_stats(df, 'text_length_group', '投稿の文字数別 (固定ビン)', f)
 
+        # カテゴリを付けた経路 (llm / knn / local_classifier)。列がある場合のみ
+        if 'label_source' in df.columns:
+            df['label_source'] = df['label_source'].fillna('llm')
+            calculate_and_display_stats(df, 'label_source', '分類経路別', f)
+
 
     print(f"\n✅ 集計サマリーを {SUMMARY_FILE} に保存しました。")
     print("このファイルをメモ帳などで開き、内容をExcelにコピー＆ペーストしてグラフを作成してください。")
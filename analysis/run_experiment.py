@@ -7,6 +7,9 @@ import time
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
     from app import llm_analyzer
+    from app import database
+    from app import embedding_cache
+    from app import text_preprocess
 except ImportError:
     print("【エラー】'app' モジュールが見つかりません。")
     print("このスクリプトは 'analysis' フォルダの中に配置し、")
@@ -16,6 +19,8 @@ except ImportError:
 # 入力ファイルと出力ファイルの設定
 INPUT_CSV = 'analysis_for_checking_01.csv'
 OUTPUT_CSV = 'analysis/experiment_result.csv' # 新しい分析結果
+# True にすると分析結果（カテゴリ＋埋め込み）を post_analysis_cache にまとめて保存する
+SAVE_TO_CACHE = False
 
 def main():
     # 1. データセットの読み込み
@@ -49,6 +54,14 @@ def main():
     end_time = time.time()
     
     print(f"分析完了 (所要時間: {end_time - start_time:.2f}秒)")
+    # 再実行では埋め込みはキャッシュから返り、分類だけがLLMに送られる
+    print(f"埋め込みキャッシュ: {embedding_cache.cache_stats.stats()}")
+    # 分類プロンプトに貼る前の前処理で削った推定トークン数
+    print(f"入力の前処理: {text_preprocess.preprocess_stats.stats()}")
+
+    if SAVE_TO_CACHE:
+        saved = database.save_analysis_results_bulk(zip(uris, results))
+        print(f"分析結果 {saved} 件を post_analysis_cache に保存しました。")
 
     # 3. 結果の集計と保存
     new_rows = []
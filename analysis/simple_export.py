@@ -26,6 +26,7 @@ def simple_export():
         p.content_category,
         p.expression_category,
         p.style_stance_category,
+        p.label_source,
         f.post_uri
     FROM filter_feedback f
     LEFT JOIN post_analysis_cache p ON f.post_uri = p.post_uri
@@ -78,6 +79,7 @@ def simple_export():
         u.user_did,
         p.content_category,
         p.expression_category,
+        p.label_source,
         u.post_uri
     FROM unpleasant_feedback u
     LEFT JOIN post_analysis_cache p ON u.post_uri = p.post_uri
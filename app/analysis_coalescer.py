@@ -0,0 +1,226 @@
+# analysis_coalescer.py
+# 全セッションからの分析依頼を集め、LLMのバッチにまとめて送る（ワーカープロセス単位）。
+# 同じキー（本文ハッシュ、無ければURI）が既に処理中なら新しく送らず、その結果を待つ（singleflight）。
+# 検索フィードのように同じ投稿を多くのユーザーが同時に開く場合に、Geminiの呼び出し回数と429を減らす。
+#
+# 埋め込みと分類は別々のキュー（ステージ）で、それぞれに合ったバッチの大きさ・同時実行数で並行して処理し、
+# 両方の結果が揃った時点でキーごとに1件の分析結果にまとめる。
+# ラベル伝播 (label_propagation) かローカル分類器 (local_classifier) が使える間は先に埋め込みを求め、
+# 近傍のラベルも分類器の予測も使えなかった投稿だけを分類ステージに送る。
+
+import asyncio
+import os
+from collections import OrderedDict
+from itertools import islice
+
+try:
+    import batch_planner
+    import label_propagation
+    import llm_analyzer
+    import local_classifier
+    import text_preprocess
+except ImportError:
+    from app import batch_planner
+    from app import label_propagation
+    from app import llm_analyzer
+    from app import local_classifier
+    from app import text_preprocess
+
+MAX_WAIT_SECONDS = float(os.getenv('COALESCE_MAX_WAIT_MS', '50')) / 1000     # 他の依頼と合流させるために待つ時間
+MAX_CONCURRENT_BATCHES = int(os.getenv('COALESCE_MAX_CONCURRENT_BATCHES', '4'))
+MAX_CONCURRENT_EMBED_BATCHES = int(os.getenv('COALESCE_MAX_CONCURRENT_EMBED_BATCHES', '2'))
+
+class _Stage:
+    """
+    1種類の呼び出しのキュー。溜まった依頼をバッチにして送り、投稿ごとの結果を Future に返す。
+    依頼の中身は埋め込み・分類では本文、近傍検索では埋め込み。
+    """
+
+    def __init__(self, name: str, run_batch, target_size, take, max_wait: float, max_concurrent_batches: int):
+        self.name = name
+        self.run_batch = run_batch       # 依頼のリスト → 同じ順の結果のリスト（失敗した投稿は None）
+        self.target_size = target_size   # 1バッチの目標件数（これ未満しか溜まっていなければ少し待つ）
+        self.take = take                 # キュー先頭の依頼のリスト → 次のバッチに入れる件数
+        self.max_wait = max_wait
+        self.max_concurrent_batches = max_concurrent_batches
+        self._pending = OrderedDict()    # キー → (依頼, Future)（まだ送っていないもの）
+        self._wakeup = None
+        self._slots = None
+        self._worker = None
+        self._tasks = set()              # 送信中のバッチ（GCで消えないように参照を保持する）
+        self._stats = {'batches': 0, 'batched_texts': 0, 'failed_batches': 0, 'max_pending': 0}
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for _, future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def submit(self, key, item) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = (item, future)
+        self._stats['max_pending'] = max(self._stats['max_pending'], len(self._pending))
+        self._wakeup.set()
+        return future
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # バッチが埋まっていなければ少し待って、他のセッションの依頼と合流させる
+            if len(self._pending) < self.target_size():
+                await asyncio.sleep(self.max_wait)
+            while self._pending:
+                # 同時に送るバッチ数の上限に達している間はキューに溜めておき、次のバッチを大きくする
+                await self._slots.acquire()
+                head = [text for text, _ in islice(self._pending.values(), self.target_size())]
+                size = min(max(1, self.take(head)), len(self._pending))
+                batch = [self._pending.popitem(last=False)[1] for _ in range(size)]
+                task = asyncio.create_task(self._dispatch(batch))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: list[tuple]):
+        try:
+            results = await self.run_batch([text for text, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"結果の件数が一致しません (期待: {len(batch)}, 実際: {len(results)})")
+            self._stats['batches'] += 1
+            self._stats['batched_texts'] += len(batch)
+        except Exception as e:
+            self._stats['failed_batches'] += 1
+            print(f"⚠️ まとめ処理 ({self.name}) に失敗しました ({len(batch)}件): {e}")
+            # 片方のステージの失敗で、もう片方の結果まで捨てないように None を返す
+            results = [None] * len(batch)
+        finally:
+            self._slots.release()
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats.update({
+            'pending': len(self._pending),
+            'target_batch_size': self.target_size(),
+            'avg_batch_size': stats['batched_texts'] / stats['batches'] if stats['batches'] else 0.0,
+        })
+        return stats
+
+class AnalysisCoalescer:
+    def __init__(self, embed=llm_analyzer.embed_texts_async, classify=llm_analyzer.classify_texts_async,
+                 planner=batch_planner.planner, classifier=local_classifier.classifier,
+                 propagator=label_propagation.propagator, max_wait: float = MAX_WAIT_SECONDS,
+                 max_concurrent_batches: int = MAX_CONCURRENT_BATCHES,
+                 max_concurrent_embed_batches: int = MAX_CONCURRENT_EMBED_BATCHES):
+        # 分類のバッチの大きさは batch_planner が（前処理後の本文の）推定トークン数と直近の応答状況から決める
+        self.classify_stage = _Stage(
+            'classify', classify,
+            target_size=lambda: planner.batch_posts,
+            take=lambda texts: planner.take([llm_analyzer.prompt_tokens(text) for text in texts]),
+            max_wait=max_wait, max_concurrent_batches=max_concurrent_batches,
+        )
+        # 埋め込みは出力の打ち切りが無いので、バックエンドが1回に受け付けるだけ載せる
+        self.embed_stage = _Stage(
+            'embed', embed,
+            target_size=lambda: llm_analyzer.embedder.batch_size,
+            take=len,
+            max_wait=max_wait, max_concurrent_batches=max_concurrent_embed_batches,
+        )
+        # 近傍検索は1回のクエリで複数の投稿の近傍をまとめて探す
+        self.neighbor_stage = _Stage(
+            'neighbors', propagator.propagate,
+            target_size=lambda: label_propagation.BATCH_SIZE,
+            take=len,
+            max_wait=max_wait, max_concurrent_batches=max_concurrent_embed_batches,
+        )
+        self.classifier = classifier
+        self.propagator = propagator
+        self._inflight = {}   # キー → 結合した分析結果を受け取る Future（キュー待ち + 送信中）
+        self._stats = {'requested': 0, 'coalesced': 0}
+        self._label_sources = {}   # カテゴリを付けた経路 → 件数
+
+    # --- 起動と停止 ---
+    def start(self):
+        self.classify_stage.start()
+        self.embed_stage.start()
+        self.neighbor_stage.start()
+
+    async def stop(self):
+        await self.classify_stage.stop()
+        await self.embed_stage.stop()
+        await self.neighbor_stage.stop()
+        for future in self._inflight.values():
+            future.cancel()
+        self._inflight.clear()
+
+    # --- 依頼の受付 ---
+    async def analyze(self, keys: list, texts: list[str]) -> list[dict]:
+        """
+        キーの順に分析結果を返す。処理中のキーは既存の Future を共有し、新しいキーだけを両ステージのキューに積む。
+        待っている側がキャンセルされても、共有している Future は他の待ち手のために残す。
+        """
+        self.start()
+        futures, new_texts = [], []
+        for key, text in zip(keys, texts):
+            future = self._inflight.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self._join(key, text))
+                self._inflight[key] = future
+                new_texts.append(text)
+            else:
+                self._stats['coalesced'] += 1
+            futures.append(future)
+        self._stats['requested'] += len(futures)
+        text_preprocess.log_summary(new_texts)
+        return await asyncio.gather(*(asyncio.shield(future) for future in futures))
+
+    async def _join(self, key, text: str) -> dict:
+        """埋め込みとカテゴリが揃ったら1件の分析結果にまとめる"""
+        try:
+            if not (self.propagator.enabled or self.classifier.ready):
+                # 埋め込みを使ってカテゴリを決める経路が無いので、2つのステージを並行して待つ
+                categories = self.classify_stage.submit(key, text)
+                embedding = self.embed_stage.submit(key, text)
+                categories, embedding = await categories, await embedding
+            else:
+                # 近傍のラベル → ローカル分類器 → LLM の順に、使えるものでカテゴリを決める
+                embedding = await self.embed_stage.submit(key, text)
+                categories = None
+                if embedding is not None and self.propagator.enabled:
+                    categories = await self.neighbor_stage.submit(key, embedding)
+                if categories is None:
+                    categories = self.classifier.predict(embedding)
+                if categories is None:
+                    categories = await self.classify_stage.submit(key, text)
+            source = categories.get('label_source', 'llm') if categories is not None else 'failed'
+            self._label_sources[source] = self._label_sources.get(source, 0) + 1
+            return llm_analyzer.merge_result(categories, embedding)
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats.update({
+            'inflight': len(self._inflight),
+            'coalesce_rate': stats['coalesced'] / stats['requested'] if stats['requested'] else 0.0,
+            'label_sources': dict(self._label_sources),
+            'classify': self.classify_stage.stats(),
+            'embed': self.embed_stage.stats(),
+            'neighbors': self.neighbor_stage.stats(),
+        })
+        return stats
+
+coalescer = AnalysisCoalescer()
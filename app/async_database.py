@@ -0,0 +1,262 @@
+# async_database.py
+# database.py と同じ関数群の asyncio 版。FastAPI のハンドラーからはこちらを await して使う。
+# analysis/ と maintenance/ のスクリプトは従来どおり同期版の database.py を使う。
+
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+import asyncpg
+import numpy as np
+from dotenv import load_dotenv
+from pgvector.asyncpg import register_vector
+
+try:
+    import database
+    import embedding_provider
+    import filter_context
+except ImportError:
+    from app import database
+    from app import embedding_provider
+    from app import filter_context
+
+load_dotenv()
+DB_NAME = os.getenv('POSTGRES_DB')
+DB_USER = os.getenv('POSTGRES_USER')
+DB_PASS = os.getenv('POSTGRES_PASSWORD')
+DB_HOST = os.getenv('POSTGRES_HOST')
+
+POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', '10'))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))
+
+_pool = None
+_pool_lock = asyncio.Lock()
+_waits = deque(maxlen=1000)
+_stats = {'checkouts': 0, 'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+async def _init_connection(conn):
+    """物理接続ごとに1回だけ pgvector の型を登録する"""
+    try:
+        await register_vector(conn)
+    except Exception as e:
+        print(f"⚠️ vector型の登録警告: {e}")
+
+async def open_pool():
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                database=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST,
+                min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=POOL_MAX_INACTIVE_LIFETIME,
+                init=_init_connection
+            )
+    return _pool
+
+async def close_pool():
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+class _Acquire:
+    """pool.acquire() に待ち時間の計測を加えたもの"""
+    def __init__(self):
+        self.pool = None
+        self.conn = None
+
+    async def __aenter__(self):
+        # 返却は取得したプールに対して行う（途中で close_pool() やプールの作り直しがあっても取り違えない）
+        self.pool = _pool or await open_pool()
+        start = time.monotonic()
+        self.conn = await self.pool.acquire(timeout=POOL_TIMEOUT)
+        wait_seconds = time.monotonic() - start
+        _stats['checkouts'] += 1
+        _stats['total_wait_seconds'] += wait_seconds
+        _stats['max_wait_seconds'] = max(_stats['max_wait_seconds'], wait_seconds)
+        _waits.append(wait_seconds)
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        await self.pool.release(self.conn)
+
+def connection():
+    return _Acquire()
+
+def get_pool_stats() -> dict:
+    stats = dict(_stats)
+    waits = sorted(_waits)
+    stats['avg_wait_seconds'] = stats['total_wait_seconds'] / stats['checkouts'] if stats['checkouts'] else 0.0
+    stats['p95_wait_seconds'] = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+    if _pool is not None:
+        stats.update({'max_size': _pool.get_max_size(), 'size': _pool.get_size(), 'idle': _pool.get_idle_size()})
+    return stats
+
+# --- database.py と同じ関数群 ---
+
+async def add_unpleasant_feedback(user_did: str, post_uri: str):
+    now = datetime.now()
+    async with connection() as conn:
+        await conn.execute('INSERT INTO unpleasant_feedback (user_did, post_uri, reported_at) VALUES ($1, $2, $3) ON CONFLICT (user_did, post_uri) DO NOTHING', user_did, post_uri, now)
+    filter_context.context_cache.invalidate(user_did)
+
+async def get_unpleasant_feedback_uris(user_did: str) -> list[str]:
+    async with connection() as conn:
+        results = await conn.fetch("SELECT post_uri FROM unpleasant_feedback WHERE user_did = $1", user_did)
+    return [result['post_uri'] for result in results]
+
+async def get_unpleasant_post_vectors(user_did: str) -> list[np.ndarray]:
+    query = """
+    SELECT cache.embedding::real[] AS embedding
+    FROM unpleasant_feedback AS feedback
+    JOIN post_analysis_cache AS cache ON feedback.post_uri = cache.post_uri
+    WHERE feedback.user_did = $1 AND cache.embedding IS NOT NULL AND cache.embedding_model = $2;
+    """
+    async with connection() as conn:
+        results = await conn.fetch(query, user_did, database.EMBEDDING_MODEL_ID)
+    return [np.asarray(result['embedding'], dtype=np.float32) for result in results]
+
+async def add_or_update_hexaco_result(user_did: str, handle: str, scores: dict):
+    now = datetime.now()
+    async with connection() as conn:
+        async with conn.transaction():
+            await conn.execute('INSERT INTO users (user_did, handle, created_at) VALUES ($1, $2, $3) ON CONFLICT (user_did) DO UPDATE SET handle = EXCLUDED.handle', user_did, handle, now)
+            await conn.execute('INSERT INTO hexaco_results (user_did, H, E, X, A, C, O, diagnosed_at) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)', user_did, scores['H'], scores['E'], scores['X'], scores['A'], scores['C'], scores['O'], now)
+    filter_context.context_cache.invalidate(user_did)
+
+async def get_user_result(user_did: str):
+    async with connection() as conn:
+        result = await conn.fetchrow('SELECT * FROM hexaco_results WHERE user_did = $1 ORDER BY diagnosed_at DESC LIMIT 1', user_did)
+    return dict(result) if result else None
+
+async def get_user_filter_settings(user_did: str):
+    async with connection() as conn:
+        settings = await conn.fetchrow("SELECT hidden_content_categories, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold FROM filter_settings WHERE user_did = $1", user_did)
+    if settings: return dict(settings)
+    else: return {'hidden_content_categories': [], 'auto_filter_enabled': True, 'similarity_filter_enabled': True, 'filter_strength': 2, 'similarity_threshold': 0.80}
+
+async def load_user_filter_context(user_did: str) -> filter_context.UserFilterContext:
+    """設定・最新スコア・報告済みURI・報告済みベクトルを1往復で取得する"""
+    cached = filter_context.context_cache.get(user_did)
+    if cached is not None:
+        return cached
+    version = filter_context.context_cache.version(user_did)
+    query = filter_context.USER_FILTER_CONTEXT_QUERY.format(param='$1', model='$2')
+    async with connection() as conn:
+        row = await conn.fetchrow(query, user_did, database.EMBEDDING_MODEL_ID)
+    context = filter_context.build_user_filter_context(row)
+    filter_context.context_cache.put(user_did, version, context)
+    return context
+
+async def save_user_filter_settings(user_did: str, content: list[str], auto_filter: bool, similarity_filter: bool, filter_strength: int, similarity_threshold: float):
+    now = datetime.now()
+    async with connection() as conn:
+        await conn.execute('''
+            INSERT INTO filter_settings (user_did, hidden_content_categories, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold, updated_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (user_did) DO UPDATE SET
+                hidden_content_categories = EXCLUDED.hidden_content_categories,
+                auto_filter_enabled = EXCLUDED.auto_filter_enabled,
+                similarity_filter_enabled = EXCLUDED.similarity_filter_enabled,
+                filter_strength = EXCLUDED.filter_strength,
+                similarity_threshold = EXCLUDED.similarity_threshold,
+                updated_at = EXCLUDED.updated_at
+        ''', user_did, content, auto_filter, similarity_filter, filter_strength, similarity_threshold, now)
+    filter_context.context_cache.invalidate(user_did)
+
+async def get_cached_analysis_results(post_uris: list[str], with_embedding: bool = True) -> dict[str, dict]:
+    """キャッシュ済みの分析結果を {URI: 行} で返す（asyncpg がステートメントを自動でプリペアする）"""
+    if not post_uris: return {}
+    _, query = database.CACHED_ANALYSIS_QUERIES[with_embedding]
+    params = (list(post_uris), database.EMBEDDING_MODEL_ID) if with_embedding else (list(post_uris),)
+    async with connection() as conn:
+        cached_results = [dict(row) for row in await conn.fetch(query.format(uris='$1::text[]', model='$2'), *params)]
+    if with_embedding:
+        database.decode_cached_embeddings(cached_results)
+    return {result['post_uri']: result for result in cached_results}
+
+async def get_similar_post_uris(user_did: str, post_uris: list[str], similarity_threshold: float) -> set[str]:
+    """1ページ分の候補URIについて、不快報告済みの投稿に類似するものをDB側でまとめて判定する"""
+    if not post_uris: return set()
+    query = database.SIMILAR_POST_URIS_QUERY.format(uris='$1::text[]', user_did='$2', threshold='$3')
+    async with connection() as conn:
+        results = await conn.fetch(query, list(post_uris), user_did, similarity_threshold)
+    return {result['post_uri'] for result in results}
+
+async def save_analysis_results(post_uri: str, analysis_result: dict):
+    if not analysis_result or 'embedding' not in analysis_result or analysis_result['embedding'] is None:
+        return
+    now = datetime.now()
+    content = analysis_result.get('content_category', '不明')
+    expression = analysis_result.get('expression_category', '不明')
+    style = analysis_result.get('style_stance_category', '不明')
+    embedding = np.asarray(analysis_result['embedding'], dtype=np.float32)
+    async with connection() as conn:
+        await conn.execute('''
+            INSERT INTO post_analysis_cache (post_uri, content_category, expression_category, style_stance_category, embedding, analyzed_at, embedding_model, embedding_dim)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT (post_uri) DO NOTHING
+        ''', post_uri, content, expression, style, embedding, now, database.EMBEDDING_MODEL_ID, len(embedding))
+
+async def save_analysis_results_bulk(items, text_hashes: dict | None = None) -> int:
+    """複数の分析結果を1トランザクションでまとめて保存する（database.save_analysis_results_bulk と同じ）"""
+    rows = database._analysis_rows(items, datetime.now(), text_hashes)
+    if not rows: return 0
+    async with connection() as conn:
+        async with conn.transaction():
+            await conn.executemany('''
+                INSERT INTO post_analysis_cache (post_uri, content_category, expression_category, style_stance_category, embedding, analyzed_at, text_hash, embedding_model, embedding_dim, label_source)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10) ON CONFLICT (post_uri) DO NOTHING
+            ''', rows)
+    return len(rows)
+
+async def get_analysis_results_by_text_hash(text_hashes: list[str]) -> dict[str, dict]:
+    """本文ハッシュごとの既存の分析結果（カテゴリ＋埋め込み）を返す"""
+    if not text_hashes: return {}
+    async with connection() as conn:
+        rows = [dict(row) for row in await conn.fetch(database.ANALYSIS_BY_TEXT_HASH_QUERY.format(hashes='$1::text[]', model='$2'), list(text_hashes), database.EMBEDDING_MODEL_ID)]
+    return database._text_hash_results(rows)
+
+async def get_cached_embeddings(text_hashes: list[str], embedding_model: str) -> dict[str, list]:
+    """{本文ハッシュ: 埋め込み} を返す（database.get_cached_embeddings と同じ）"""
+    if not text_hashes: return {}
+    async with connection() as conn:
+        rows = [dict(row) for row in await conn.fetch(
+            database.CACHED_EMBEDDINGS_QUERY.format(model='$1', hashes='$2::text[]'), embedding_model, list(text_hashes)
+        )]
+    return database._cached_embeddings(rows)
+
+async def save_cached_embeddings(items: list[tuple], embedding_model: str) -> int:
+    rows = [(h, embedding_model, np.asarray(embedding, dtype=np.float32)) for h, embedding in items]
+    if not rows: return 0
+    async with connection() as conn:
+        await conn.executemany(database.SAVE_CACHED_EMBEDDINGS_QUERY.format(values='($1, $2, $3)'), rows)
+    return len(rows)
+
+async def get_label_neighbors(embeddings: list, k: int) -> list[list[dict]]:
+    """埋め込みごとに、LLMが分類した近傍の投稿（カテゴリと類似度）を近い順に返す"""
+    if not embeddings: return []
+    query = database.LABEL_NEIGHBORS_QUERY.format(
+        embeddings='$1', model='$2', excluded='$3::text[]', k='$4', dim=embedding_provider.COLUMN_DIMENSION
+    )
+    async with connection() as conn:
+        rows = await conn.fetch(
+            query, [database.vector_literal(embedding) for embedding in embeddings],
+            database.EMBEDDING_MODEL_ID, database.UNLABELLED_CATEGORIES, k
+        )
+    neighbors = [[] for _ in embeddings]
+    for row in rows:
+        neighbors[row['idx'] - 1].append(dict(row))
+    return neighbors
+
+async def add_filter_feedback(user_did: str, post_uri: str, filter_type: str, feedback: str):
+    now = datetime.now()
+    async with connection() as conn:
+        await conn.execute(
+            'INSERT INTO filter_feedback (user_did, post_uri, filter_type, feedback, created_at) VALUES ($1, $2, $3, $4, $5)',
+            user_did, post_uri, filter_type, feedback, now
+        )
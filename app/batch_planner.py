@@ -0,0 +1,99 @@
+# batch_planner.py
+# LLMの分類プロンプトに何件の投稿を載せるかを決める。
+# 投稿の推定トークン数で詰め込み（長い投稿が多ければ件数を減らす）、1バッチあたりの目標件数は
+# 実際の応答（所要時間・出力の打ち切り・件数不一致）を見て増減させる。
+#   - 打ち切り・件数不一致: 目標件数を乗算的に減らす
+#   - 成功かつ目標時間内: 目標件数を1件ずつ増やす（所要時間が目標を超えたら少し減らす）
+
+import os
+import threading
+
+TOKEN_BUDGET = int(os.getenv('LLM_BATCH_TOKEN_BUDGET', '6000'))            # 1バッチに載せる投稿本文の推定トークン数の上限
+MIN_POSTS = int(os.getenv('LLM_BATCH_MIN_POSTS', '1'))
+MAX_POSTS = int(os.getenv('LLM_BATCH_MAX_POSTS', '40'))
+INITIAL_POSTS = float(os.getenv('LLM_BATCH_INITIAL_POSTS', '10'))
+TARGET_LATENCY = float(os.getenv('LLM_BATCH_TARGET_LATENCY', '20'))         # 1バッチの所要時間の目標（秒）
+
+DECREASE_ON_FAILURE = 0.7
+DECREASE_ON_SLOW = 0.9
+EWMA_ALPHA = 0.1
+
+OUTCOMES = ('ok', 'truncated', 'mismatch', 'blocked')
+
+class BatchPlanner:
+    def __init__(self, token_budget: int = TOKEN_BUDGET, min_posts: int = MIN_POSTS, max_posts: int = MAX_POSTS,
+                 initial_posts: float = INITIAL_POSTS, target_latency: float = TARGET_LATENCY):
+        self.token_budget = token_budget
+        self.min_posts = min_posts
+        self.max_posts = max_posts
+        self.target_latency = target_latency
+        self.target_posts = min(max_posts, max(min_posts, initial_posts))
+        self._lock = threading.Lock()
+        self._counts = {outcome: 0 for outcome in OUTCOMES}
+        self._rates = {outcome: 0.0 for outcome in OUTCOMES}   # 直近の結果の指数移動平均
+        self._latency = None
+        self._posts_per_second = None
+
+    @property
+    def batch_posts(self) -> int:
+        return int(self.target_posts)
+
+    def take(self, token_counts: list[int]) -> int:
+        """先頭から何件を1バッチにするか（最低1件。1件で予算を超える長い投稿は単独で送る）"""
+        limit = self.batch_posts
+        total = 0
+        for n, tokens in enumerate(token_counts[:limit]):
+            if n > 0 and total + tokens > self.token_budget:
+                return n
+            total += tokens
+        return min(limit, len(token_counts))
+
+    def plan(self, token_counts: list[int]) -> list[range]:
+        """投稿を先頭から順にバッチへ詰め、各バッチの位置の範囲を返す"""
+        batches, start = [], 0
+        while start < len(token_counts):
+            n = max(1, self.take(token_counts[start:]))
+            batches.append(range(start, start + n))
+            start += n
+        return batches
+
+    def observe(self, n_posts: int, latency: float, outcome: str):
+        """1回の分類呼び出しの結果を反映して目標件数を調整する"""
+        with self._lock:
+            self._counts[outcome] += 1
+            for name in OUTCOMES:
+                self._rates[name] += EWMA_ALPHA * ((name == outcome) - self._rates[name])
+
+            if outcome == 'blocked':
+                # 安全フィルターによるブロックは投稿の内容の問題なので、バッチの大きさは変えない
+                return
+            if outcome != 'ok':
+                # 出力の上限に当たった・件数を数え間違えた場合は、そのバッチより小さくする
+                self.target_posts = max(self.min_posts, min(self.target_posts, n_posts) * DECREASE_ON_FAILURE)
+                return
+
+            self._latency = latency if self._latency is None else self._latency + EWMA_ALPHA * (latency - self._latency)
+            if latency > 0:
+                rate = n_posts / latency
+                self._posts_per_second = rate if self._posts_per_second is None else self._posts_per_second + EWMA_ALPHA * (rate - self._posts_per_second)
+
+            if latency > self.target_latency:
+                self.target_posts = max(self.min_posts, self.target_posts * DECREASE_ON_SLOW)
+            elif n_posts >= self.batch_posts:
+                # 目標件数いっぱいのバッチが問題なく返ってきたときだけ増やす（小さなバッチの成功では判断しない）
+                self.target_posts = min(self.max_posts, self.target_posts + 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'target_posts': self.batch_posts,
+                'token_budget': self.token_budget,
+                'calls': dict(self._counts),
+                'truncation_rate': self._rates['truncated'],
+                'mismatch_rate': self._rates['mismatch'],
+                'blocked_rate': self._rates['blocked'],
+                'avg_latency_seconds': self._latency,
+                'posts_per_second': self._posts_per_second,
+            }
+
+planner = BatchPlanner()
@@ -6,7 +6,17 @@ import psycopg2.extras
 from datetime import datetime
 from dotenv import load_dotenv
 import numpy as np
-from pgvector.psycopg2 import register_vector
+
+try:
+    import db_pool
+    import embedding_provider
+    import filter_context
+    import migrations
+except ImportError:
+    from app import db_pool
+    from app import embedding_provider
+    from app import filter_context
+    from app import migrations
 
 load_dotenv()
 DB_NAME = os.getenv('POSTGRES_DB')
@@ -14,101 +24,118 @@ DB_USER = os.getenv('POSTGRES_USER')
 DB_PASS = os.getenv('POSTGRES_PASSWORD')
 DB_HOST = os.getenv('POSTGRES_HOST')
 
+# 保存する埋め込みのモデル。読み出し・類似判定ではこのモデルの埋め込みだけを使う
+EMBEDDING_MODEL_ID = embedding_provider.MODEL_ID
+
+# LLMが分類できなかった投稿のカテゴリ。ローカル分類器の学習・ラベル伝播には使わない
+UNLABELLED_CATEGORIES = ['分析失敗', '分類不能']
+
+# 候補URIのうち、ユーザーが報告した投稿のいずれかとコサイン類似度が閾値を超えるものを返す
+# （<=> はコサイン距離 = 1 - コサイン類似度。別のモデルの埋め込み同士は比較しない）
+# 候補は1ページ分、報告はユーザー1人分なので、主キーで引いた行同士の距離を全て正確に計算する
+# （HNSWの近似検索に URI の条件を付けると、近傍の上位 ef_search 件に入らない候補が漏れる）
+SIMILAR_POST_URIS_QUERY = """
+SELECT DISTINCT candidate.post_uri
+FROM post_analysis_cache AS candidate
+JOIN post_analysis_cache AS reported ON reported.embedding_model = candidate.embedding_model
+JOIN unpleasant_feedback AS feedback ON feedback.post_uri = reported.post_uri
+WHERE candidate.post_uri = ANY({uris})
+  AND candidate.embedding IS NOT NULL
+  AND feedback.user_did = {user_did}
+  AND reported.embedding IS NOT NULL
+  AND (candidate.embedding <=> reported.embedding) < 1 - {threshold}::float8
+"""
+
+# post_analysis_cache.embedding は半精度 (halfvec) で保存している（migrations の version 4）
+EMBEDDING_WIRE_DTYPE = '>f2'
+
+# キャッシュ参照。ベクトルは halfvec_send() のバイナリで受け取り、テキストの解析を省く
+# 別のモデルで計算した埋め込みは類似判定に使えないので返さない（カテゴリはそのまま使う）
+CACHED_ANALYSIS_COLUMNS = "post_uri, content_category, expression_category, style_stance_category"
+CACHED_ANALYSIS_QUERIES = {
+    False: ("cached_analysis_categories",
+            "SELECT " + CACHED_ANALYSIS_COLUMNS + " FROM post_analysis_cache WHERE post_uri = ANY({uris})"),
+    True: ("cached_analysis_with_halfvec",
+           "SELECT " + CACHED_ANALYSIS_COLUMNS + ", CASE WHEN embedding_model = {model} THEN halfvec_send(embedding) END AS embedding_bin"
+           " FROM post_analysis_cache WHERE post_uri = ANY({uris})"),
+}
+
+# 本文ハッシュが同じ投稿の最新の分析結果を1件ずつ返す（現在のモデルの埋め込みがあるものだけ）
+ANALYSIS_BY_TEXT_HASH_QUERY = """
+SELECT DISTINCT ON (text_hash)
+    text_hash, content_category, expression_category, style_stance_category, label_source,
+    halfvec_send(embedding) AS embedding_bin
+FROM post_analysis_cache
+WHERE text_hash = ANY({hashes}) AND embedding IS NOT NULL AND embedding_model = {model}
+ORDER BY text_hash, analyzed_at DESC
+"""
+
+# 埋め込みキャッシュ (embedding_cache.py)
+CACHED_EMBEDDINGS_QUERY = """
+SELECT text_hash, halfvec_send(embedding) AS embedding_bin
+FROM embedding_cache
+WHERE embedding_model = {model} AND text_hash = ANY({hashes})
+"""
+SAVE_CACHED_EMBEDDINGS_QUERY = """
+INSERT INTO embedding_cache (text_hash, embedding_model, embedding) VALUES {values}
+ON CONFLICT (text_hash, embedding_model) DO NOTHING
+"""
+
+# ローカル分類器 (local_classifier) の学習データ。LLMが付けたラベルだけを新しい順に返す
+CLASSIFIER_TRAINING_QUERY = """
+SELECT content_category, expression_category, style_stance_category,
+    halfvec_send(embedding) AS embedding_bin
+FROM post_analysis_cache
+WHERE embedding IS NOT NULL AND embedding_model = %s AND label_source = 'llm'
+  AND NOT (content_category = ANY(%s) OR expression_category = ANY(%s) OR style_stance_category = ANY(%s))
+ORDER BY analyzed_at DESC
+LIMIT %s
+"""
+
+# 埋め込みごとに、LLMが分類した投稿を近い順に {k} 件返す（label_propagation 用。HNSWインデックスを使う）
+# 埋め込みは '[0.1,0.2,...]' 形式のテキストの配列で受け取る
+LABEL_NEIGHBORS_QUERY = """
+SELECT query.idx, neighbor.content_category, neighbor.expression_category, neighbor.style_stance_category, neighbor.similarity
+FROM unnest({embeddings}::text[]) WITH ORDINALITY AS query(embedding, idx)
+CROSS JOIN LATERAL (
+    SELECT cache.content_category, cache.expression_category, cache.style_stance_category,
+        1 - (cache.embedding <=> query.embedding::halfvec({dim})) AS similarity
+    FROM post_analysis_cache AS cache
+    WHERE cache.embedding_model = {model} AND cache.label_source = 'llm'
+      AND cache.content_category <> ALL({excluded}) AND cache.expression_category <> ALL({excluded})
+      AND cache.style_stance_category <> ALL({excluded})
+    ORDER BY cache.embedding <=> query.embedding::halfvec({dim})
+    LIMIT {k}
+) AS neighbor
+"""
+
 def get_connection():
-    """アプリケーション用の接続を取得（pgvector登録付き）"""
+    """プールから接続を借りる（pgvector登録済み）。close() でプールへ返却される"""
     try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS,
-            host=DB_HOST,
-            cursor_factory=psycopg2.extras.RealDictCursor
-        )
-        # アプリでの利用時はpgvectorを登録する
-        try:
-            register_vector(conn)
-        except Exception as e:
-            print(f"⚠️ vector型の登録警告: {e}")
-        return conn
+        return db_pool.get_pool().getconn()
     except Exception as e:
         print(f"❌ データベース接続エラー: {e}")
         raise e
 
+def get_pool_stats() -> dict:
+    """コネクションプールの待ち時間メトリクスを返す"""
+    return db_pool.get_pool_stats()
+
+def close_pool():
+    db_pool.close_pool()
+
 def initialize_database():
-    """データベースとテーブルを初期化する（DDL専用接続を使用）"""
+    """未適用のスキーマ移行を適用する（DDL専用接続を使用）"""
     print("🚀 データベース初期化プロセスを開始します...")
     
     try:
         # 【修正点】get_connection()を使わず、素の接続を使う
         # これにより register_vector に起因するトランザクション問題を回避する
         conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST)
-        conn.autocommit = True # エラー回避のため即座に自動コミットモードへ
-        cursor = conn.cursor()
-
-        print("🔧 pgvector拡張機能を確認中...")
         try:
-            cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-        except Exception as e:
-            print(f"⚠️ 拡張機能スキップ（すでに存在する等）: {e}")
-
-        print("🛠️ テーブルを作成中...")
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_did TEXT PRIMARY KEY, handle TEXT NOT NULL, created_at TIMESTAMPTZ NOT NULL
-        )''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS hexaco_results (
-            result_id SERIAL PRIMARY KEY, user_did TEXT NOT NULL,
-            H REAL NOT NULL, E REAL NOT NULL, X REAL NOT NULL,
-            A REAL NOT NULL, C REAL NOT NULL, O REAL NOT NULL,
-            diagnosed_at TIMESTAMPTZ NOT NULL,
-            FOREIGN KEY (user_did) REFERENCES users (user_did)
-        )''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS filter_settings (
-            setting_id SERIAL PRIMARY KEY, user_did TEXT NOT NULL UNIQUE,
-            hidden_content_categories TEXT[] NOT NULL,
-            auto_filter_enabled BOOLEAN NOT NULL DEFAULT TRUE,
-            similarity_filter_enabled BOOLEAN NOT NULL DEFAULT TRUE,
-            filter_strength INTEGER NOT NULL DEFAULT 2,
-            similarity_threshold REAL NOT NULL DEFAULT 0.80,
-            updated_at TIMESTAMPTZ NOT NULL,
-            FOREIGN KEY (user_did) REFERENCES users (user_did)
-        )''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS post_analysis_cache (
-            post_uri TEXT PRIMARY KEY, content_category TEXT NOT NULL,
-            expression_category TEXT NOT NULL, style_stance_category TEXT NOT NULL,
-            embedding vector(768),
-            analyzed_at TIMESTAMPTZ NOT NULL
-        )''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS unpleasant_feedback (
-            feedback_id SERIAL PRIMARY KEY, user_did TEXT NOT NULL, post_uri TEXT NOT NULL,
-            reported_at TIMESTAMPTZ NOT NULL,
-            FOREIGN KEY (user_did) REFERENCES users (user_did),
-            FOREIGN KEY (post_uri) REFERENCES post_analysis_cache (post_uri)
-        )''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS filter_feedback (
-            feedback_id SERIAL PRIMARY KEY,
-            user_did TEXT NOT NULL,
-            post_uri TEXT NOT NULL,
-            filter_type TEXT NOT NULL,
-            feedback TEXT NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL,
-            FOREIGN KEY (user_did) REFERENCES users (user_did)
-        )''')
-
-        cursor.close()
-        conn.close()
-        print("✅ 全テーブルの作成確認が完了しました。")
+            migrations.migrate(conn)
+        finally:
+            conn.close()
         
     except Exception as e:
         print(f"❌ テーブル作成中に致命的なエラーが発生: {e}")
@@ -116,130 +143,240 @@ def initialize_database():
 # --- 以下は変更なし ---
 
 def add_unpleasant_feedback(user_did: str, post_uri: str):
-    conn = get_connection()
-    cursor = conn.cursor()
     now = datetime.now()
-    cursor.execute("SELECT 1 FROM unpleasant_feedback WHERE user_did = %s AND post_uri = %s", (user_did, post_uri))
-    if cursor.fetchone():
-        cursor.close(); conn.close(); return
-    cursor.execute('INSERT INTO unpleasant_feedback (user_did, post_uri, reported_at) VALUES (%s, %s, %s)', (user_did, post_uri, now))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO unpleasant_feedback (user_did, post_uri, reported_at) VALUES (%s, %s, %s) ON CONFLICT (user_did, post_uri) DO NOTHING', (user_did, post_uri, now))
+        conn.commit()
+    filter_context.context_cache.invalidate(user_did)
 
 def get_unpleasant_feedback_uris(user_did: str) -> list[str]:
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT post_uri FROM unpleasant_feedback WHERE user_did = %s", (user_did,))
-    results = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT post_uri FROM unpleasant_feedback WHERE user_did = %s", (user_did,))
+        results = cursor.fetchall()
     return [result['post_uri'] for result in results]
 
 def get_unpleasant_post_vectors(user_did: str) -> list[np.ndarray]:
-    conn = get_connection()
-    cursor = conn.cursor()
     query = """
-    SELECT cache.embedding
+    SELECT cache.embedding::real[] AS embedding
     FROM unpleasant_feedback AS feedback
     JOIN post_analysis_cache AS cache ON feedback.post_uri = cache.post_uri
-    WHERE feedback.user_did = %s AND cache.embedding IS NOT NULL;
+    WHERE feedback.user_did = %s AND cache.embedding IS NOT NULL AND cache.embedding_model = %s;
     """
-    cursor.execute(query, (user_did,))
-    results = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [result['embedding'] for result in results]
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(query, (user_did, EMBEDDING_MODEL_ID))
+        results = cursor.fetchall()
+    return [np.asarray(result['embedding'], dtype=np.float32) for result in results]
 
 def add_or_update_hexaco_result(user_did: str, handle: str, scores: dict):
-    conn = get_connection()
-    cursor = conn.cursor()
     now = datetime.now()
-    cursor.execute('INSERT INTO users (user_did, handle, created_at) VALUES (%s, %s, %s) ON CONFLICT (user_did) DO UPDATE SET handle = EXCLUDED.handle', (user_did, handle, now))
-    cursor.execute('INSERT INTO hexaco_results (user_did, H, E, X, A, C, O, diagnosed_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', (user_did, scores['H'], scores['E'], scores['X'], scores['A'], scores['C'], scores['O'], now))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO users (user_did, handle, created_at) VALUES (%s, %s, %s) ON CONFLICT (user_did) DO UPDATE SET handle = EXCLUDED.handle', (user_did, handle, now))
+        cursor.execute('INSERT INTO hexaco_results (user_did, H, E, X, A, C, O, diagnosed_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', (user_did, scores['H'], scores['E'], scores['X'], scores['A'], scores['C'], scores['O'], now))
+        conn.commit()
+    filter_context.context_cache.invalidate(user_did)
 
 def get_user_result(user_did: str):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM hexaco_results WHERE user_did = %s ORDER BY diagnosed_at DESC LIMIT 1', (user_did,))
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT * FROM hexaco_results WHERE user_did = %s ORDER BY diagnosed_at DESC LIMIT 1', (user_did,))
+        result = cursor.fetchone()
     return result if result else None
 
 def get_user_filter_settings(user_did: str):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT hidden_content_categories, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold FROM filter_settings WHERE user_did = %s", (user_did,))
-    settings = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT hidden_content_categories, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold FROM filter_settings WHERE user_did = %s", (user_did,))
+        settings = cursor.fetchone()
     if settings: return settings
     else: return {'hidden_content_categories': [], 'auto_filter_enabled': True, 'similarity_filter_enabled': True, 'filter_strength': 2, 'similarity_threshold': 0.80}
 
+def load_user_filter_context(user_did: str) -> filter_context.UserFilterContext:
+    """設定・最新スコア・報告済みURI・報告済みベクトルを1往復で取得する"""
+    cached = filter_context.context_cache.get(user_did)
+    if cached is not None:
+        return cached
+    version = filter_context.context_cache.version(user_did)
+    query = filter_context.USER_FILTER_CONTEXT_QUERY.format(param='%s', model='%s')
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(query, (user_did, EMBEDDING_MODEL_ID))
+        row = cursor.fetchone()
+    context = filter_context.build_user_filter_context(row)
+    filter_context.context_cache.put(user_did, version, context)
+    return context
+
 def save_user_filter_settings(user_did: str, content: list[str], auto_filter: bool, similarity_filter: bool, filter_strength: int, similarity_threshold: float):
-    conn = get_connection()
-    cursor = conn.cursor()
     now = datetime.now()
-    cursor.execute('''
-        INSERT INTO filter_settings (user_did, hidden_content_categories, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold, updated_at) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (user_did) DO UPDATE SET
-            hidden_content_categories = EXCLUDED.hidden_content_categories, 
-            auto_filter_enabled = EXCLUDED.auto_filter_enabled, 
-            similarity_filter_enabled = EXCLUDED.similarity_filter_enabled,
-            filter_strength = EXCLUDED.filter_strength,
-            similarity_threshold = EXCLUDED.similarity_threshold,
-            updated_at = EXCLUDED.updated_at
-    ''', (user_did, content, auto_filter, similarity_filter, filter_strength, similarity_threshold, now))
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-def get_cached_analysis_results(post_uris: list[str]) -> dict[str, dict]:
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO filter_settings (user_did, hidden_content_categories, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold, updated_at) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (user_did) DO UPDATE SET
+                hidden_content_categories = EXCLUDED.hidden_content_categories, 
+                auto_filter_enabled = EXCLUDED.auto_filter_enabled, 
+                similarity_filter_enabled = EXCLUDED.similarity_filter_enabled,
+                filter_strength = EXCLUDED.filter_strength,
+                similarity_threshold = EXCLUDED.similarity_threshold,
+                updated_at = EXCLUDED.updated_at
+        ''', (user_did, content, auto_filter, similarity_filter, filter_strength, similarity_threshold, now))
+        conn.commit()
+    filter_context.context_cache.invalidate(user_did)
+
+def decode_cached_embeddings(rows: list[dict]) -> np.ndarray:
+    """
+    halfvec_send() のバイナリ（int16 次元数, int16 予約, float2 ビッグエンディアン × 次元数）を
+    1つの連続した float32 行列に直接展開し、各行の 'embedding' をその行ビューに置き換える。
+    """
+    dims = [int.from_bytes(bytes(row['embedding_bin'][:2]), 'big') for row in rows if row.get('embedding_bin') is not None]
+    if not dims:
+        for row in rows:
+            row.pop('embedding_bin', None)
+            row['embedding'] = None
+        return np.empty((0, 0), dtype=np.float32)
+    matrix = np.zeros((len(rows), dims[0]), dtype=np.float32)
+    for i, row in enumerate(rows):
+        raw = row.pop('embedding_bin', None)
+        if raw is None:
+            row['embedding'] = None
+            continue
+        matrix[i] = np.frombuffer(raw, dtype=EMBEDDING_WIRE_DTYPE, count=dims[0], offset=4)
+        row['embedding'] = matrix[i]
+    return matrix
+
+def get_cached_analysis_results(post_uris: list[str], with_embedding: bool = True) -> dict[str, dict]:
+    """
+    キャッシュ済みの分析結果を {URI: 行} で返す。
+    with_embedding=False ならカテゴリのみ取得し、768次元のベクトルは転送しない。
+    """
     if not post_uris: return {}
-    conn = get_connection()
-    cursor = conn.cursor()
-    placeholders = ','.join(['%s'] * len(post_uris))
-    query = f"SELECT post_uri, content_category, expression_category, style_stance_category, embedding FROM post_analysis_cache WHERE post_uri IN ({placeholders})"
-    cursor.execute(query, tuple(post_uris))
-    cached_results = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    name, query = CACHED_ANALYSIS_QUERIES[with_embedding]
+    params = (list(post_uris), EMBEDDING_MODEL_ID) if with_embedding else (list(post_uris),)
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        db_pool.execute_prepared(cursor, name, query.format(uris='$1::text[]', model='$2'), params)
+        cached_results = [dict(row) for row in cursor.fetchall()]
+    if with_embedding:
+        decode_cached_embeddings(cached_results)
     return {result['post_uri']: result for result in cached_results}
 
+def get_similar_post_uris(user_did: str, post_uris: list[str], similarity_threshold: float) -> set[str]:
+    """1ページ分の候補URIについて、不快報告済みの投稿に類似するものをDB側でまとめて判定する"""
+    if not post_uris: return set()
+    query = SIMILAR_POST_URIS_QUERY.format(uris='%s', user_did='%s', threshold='%s')
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(query, (list(post_uris), user_did, similarity_threshold))
+        results = cursor.fetchall()
+    return {result['post_uri'] for result in results}
+
 def save_analysis_results(post_uri: str, analysis_result: dict):
     if not analysis_result or 'embedding' not in analysis_result or analysis_result['embedding'] is None:
         return
-    conn = get_connection()
-    cursor = conn.cursor()
     now = datetime.now()
     content = analysis_result.get('content_category', '不明')
     expression = analysis_result.get('expression_category', '不明')
     style = analysis_result.get('style_stance_category', '不明')
-    embedding = np.array(analysis_result['embedding'])
-    cursor.execute('''
-        INSERT INTO post_analysis_cache (post_uri, content_category, expression_category, style_stance_category, embedding, analyzed_at)
-        VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (post_uri) DO NOTHING
-    ''', (post_uri, content, expression, style, embedding, now))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    embedding = np.asarray(analysis_result['embedding'], dtype=np.float32)
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO post_analysis_cache (post_uri, content_category, expression_category, style_stance_category, embedding, analyzed_at, embedding_model, embedding_dim)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (post_uri) DO NOTHING
+        ''', (post_uri, content, expression, style, embedding, now, EMBEDDING_MODEL_ID, len(embedding)))
+        conn.commit()
+
+def _analysis_rows(items, now, text_hashes: dict | None = None) -> list[tuple]:
+    """(post_uri, 分析結果) の並びから INSERT 用の行を作る（埋め込みが無いもの・重複URIは除く）"""
+    text_hashes = text_hashes or {}
+    rows, seen = [], set()
+    for post_uri, analysis_result in items:
+        if not analysis_result or analysis_result.get('embedding') is None or post_uri in seen:
+            continue
+        seen.add(post_uri)
+        embedding = np.asarray(analysis_result['embedding'], dtype=np.float32)
+        rows.append((
+            post_uri,
+            analysis_result.get('content_category', '不明'),
+            analysis_result.get('expression_category', '不明'),
+            analysis_result.get('style_stance_category', '不明'),
+            embedding,
+            now,
+            text_hashes.get(post_uri),
+            EMBEDDING_MODEL_ID,
+            len(embedding),
+            analysis_result.get('label_source', 'llm')
+        ))
+    return rows
+
+def save_analysis_results_bulk(items, text_hashes: dict | None = None, page_size: int = 500) -> int:
+    """
+    複数の分析結果を1回のコミットでまとめて保存する。既に存在するURIは無視する（ON CONFLICT DO NOTHING）。
+    items は (post_uri, 分析結果dict) の並び、text_hashes は {post_uri: 本文ハッシュ}。保存を試みた行数を返す。
+    """
+    rows = _analysis_rows(items, datetime.now(), text_hashes)
+    if not rows: return 0
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO post_analysis_cache (post_uri, content_category, expression_category, style_stance_category, embedding, analyzed_at, text_hash, embedding_model, embedding_dim, label_source)
+            VALUES %s ON CONFLICT (post_uri) DO NOTHING
+        ''', rows, page_size=page_size)
+        conn.commit()
+    return len(rows)
+
+def _text_hash_results(rows: list[dict]) -> dict[str, dict]:
+    decode_cached_embeddings(rows)
+    results = {}
+    for row in rows:
+        text_hash = row.pop('text_hash')
+        # APIの応答にそのまま載せられるよう、埋め込みはリストにしておく
+        row['embedding'] = row['embedding'].tolist() if row['embedding'] is not None else None
+        results[text_hash] = row
+    return results
+
+def get_analysis_results_by_text_hash(text_hashes: list[str]) -> dict[str, dict]:
+    """本文ハッシュごとの既存の分析結果（カテゴリ＋埋め込み）を返す"""
+    if not text_hashes: return {}
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(ANALYSIS_BY_TEXT_HASH_QUERY.format(hashes='%s', model='%s'), (list(text_hashes), EMBEDDING_MODEL_ID))
+        rows = [dict(row) for row in cursor.fetchall()]
+    return _text_hash_results(rows)
+
+def _cached_embeddings(rows: list[dict]) -> dict[str, list]:
+    decode_cached_embeddings(rows)
+    return {row['text_hash']: row['embedding'].tolist() for row in rows if row['embedding'] is not None}
+
+def get_cached_embeddings(text_hashes: list[str], embedding_model: str) -> dict[str, list]:
+    """{本文ハッシュ: 埋め込み} を返す（キャッシュに無いハッシュは含まない）"""
+    if not text_hashes: return {}
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(CACHED_EMBEDDINGS_QUERY.format(model='%s', hashes='%s'), (embedding_model, list(text_hashes)))
+        rows = [dict(row) for row in cursor.fetchall()]
+    return _cached_embeddings(rows)
+
+def save_cached_embeddings(items: list[tuple], embedding_model: str) -> int:
+    """(本文ハッシュ, 埋め込み) の並びを保存する。既にあるものは無視する。保存を試みた行数を返す"""
+    rows = [(h, embedding_model, np.asarray(embedding, dtype=np.float32)) for h, embedding in items]
+    if not rows: return 0
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        psycopg2.extras.execute_values(cursor, SAVE_CACHED_EMBEDDINGS_QUERY.format(values='%s'), rows)
+        conn.commit()
+    return len(rows)
+
+def vector_literal(embedding) -> str:
+    """pgvector のテキスト表現 '[0.1,0.2,...]'"""
+    return '[' + ','.join(map(str, np.asarray(embedding, dtype=np.float32).tolist())) + ']'
+
+def get_classifier_training_rows(limit: int) -> tuple[list[dict], np.ndarray]:
+    """ローカル分類器の学習データを (カテゴリの行, 同じ順の埋め込み行列) で返す"""
+    excluded = UNLABELLED_CATEGORIES
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(CLASSIFIER_TRAINING_QUERY, (EMBEDDING_MODEL_ID, excluded, excluded, excluded, limit))
+        rows = [dict(row) for row in cursor.fetchall()]
+    matrix = decode_cached_embeddings(rows)
+    return rows, matrix
 
 def add_filter_feedback(user_did: str, post_uri: str, filter_type: str, feedback: str):
-    conn = get_connection()
-    cursor = conn.cursor()
     now = datetime.now()
-    cursor.execute(
-        'INSERT INTO filter_feedback (user_did, post_uri, filter_type, feedback, created_at) VALUES (%s, %s, %s, %s, %s)',
-        (user_did, post_uri, filter_type, feedback, now)
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO filter_feedback (user_did, post_uri, filter_type, feedback, created_at) VALUES (%s, %s, %s, %s, %s)',
+            (user_did, post_uri, filter_type, feedback, now)
+        )
+        conn.commit()
 
 if __name__ == '__main__':
-    initialize_database()
\ No newline at end of file
+    initialize_database()
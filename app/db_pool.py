@@ -0,0 +1,282 @@
+# db_pool.py
+# psycopg2 用のコネクションプール。
+# uvicorn のワーカープロセスごとに1つ生成され、database.py と analysis/ maintenance/ のスクリプトで共有する。
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from dotenv import load_dotenv
+from pgvector.psycopg2 import register_vector
+
+load_dotenv()
+DB_NAME = os.getenv('POSTGRES_DB')
+DB_USER = os.getenv('POSTGRES_USER')
+DB_PASS = os.getenv('POSTGRES_PASSWORD')
+DB_HOST = os.getenv('POSTGRES_HOST')
+
+def _default_max_size() -> int:
+    """DBの接続上限をワーカー数で割った値を1ワーカーあたりの上限にする"""
+    workers = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+    budget = int(os.getenv('DB_MAX_CONNECTIONS', '80'))
+    return min(10, max(2, budget // workers))
+
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', str(_default_max_size())))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))              # 空き待ちの上限（秒）
+POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))  # 物理接続の寿命（秒）
+POOL_HEALTH_CHECK_IDLE = float(os.getenv('DB_POOL_HEALTH_CHECK_IDLE', '30'))  # これ以上アイドルなら貸出前に疎通確認
+WAIT_SAMPLE_SIZE = 1000
+
+class PoolTimeout(Exception):
+    """プールの空き待ちがタイムアウトした"""
+
+class PooledConnection(psycopg2.extensions.connection):
+    """プールが管理する物理接続。close() は切断せずプールへ返却する。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.checked_out = False
+        self.vector_registered = False
+        self.prepared_statements = set()
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+    def close(self):
+        if self.pool is not None and self.checked_out:
+            self.pool.putconn(self)
+        else:
+            self.close_physical()
+
+    def close_physical(self):
+        self.pool = None
+        if not self.closed:
+            super().close()
+
+class ConnectionPool:
+    def __init__(self, max_size: int = POOL_MAX_SIZE, timeout: float = POOL_TIMEOUT,
+                 max_lifetime: float = POOL_MAX_LIFETIME, health_check_idle: float = POOL_HEALTH_CHECK_IDLE):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_idle = health_check_idle
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []   # LIFO: 直近に使われた接続から再利用する
+        self._size = 0    # 生存している物理接続数（アイドル + 貸出中）
+        self._closed = False
+        self._waits = deque(maxlen=WAIT_SAMPLE_SIZE)
+        self._stats = {
+            'checkouts': 0, 'waited_checkouts': 0, 'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+            'timeouts': 0, 'connections_created': 0, 'connections_recycled': 0, 'connections_broken': 0,
+        }
+
+    # --- 物理接続の管理 ---
+    def _connect(self) -> PooledConnection:
+        conn = psycopg2.connect(
+            dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST,
+            connection_factory=PooledConnection,
+            cursor_factory=psycopg2.extras.RealDictCursor
+        )
+        with self._cond:
+            self._stats['connections_created'] += 1
+        self._register_vector(conn)
+        return conn
+
+    def _register_vector(self, conn: PooledConnection):
+        """pgvector の型登録は物理接続ごとに1回だけ行う"""
+        try:
+            register_vector(conn)
+            conn.commit()
+            conn.vector_registered = True
+        except Exception as e:
+            # 初回起動時など vector 拡張がまだ無い場合は、次回の貸出時に再試行する
+            conn.rollback()
+            print(f"⚠️ vector型の登録警告: {e}")
+
+    def _is_expired(self, conn: PooledConnection, now: float) -> bool:
+        return self.max_lifetime > 0 and now - conn.created_at > self.max_lifetime
+
+    def _is_healthy(self, conn: PooledConnection, now: float) -> bool:
+        if conn.closed:
+            return False
+        if now - conn.last_used_at < self.health_check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _prepare(self, conn):
+        """アイドル接続を検査し、寿命切れ・切断済みなら張り直して返す"""
+        if conn is None:
+            return self._connect()
+        now = time.monotonic()
+        if self._is_expired(conn, now):
+            conn.close_physical()
+            with self._cond:
+                self._stats['connections_recycled'] += 1
+            return self._connect()
+        if not self._is_healthy(conn, now):
+            conn.close_physical()
+            with self._cond:
+                self._stats['connections_broken'] += 1
+            return self._connect()
+        if not conn.vector_registered:
+            self._register_vector(conn)
+        return conn
+
+    # --- 貸出と返却 ---
+    def getconn(self) -> PooledConnection:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("コネクションプールは既に閉じられています")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"{self.timeout}秒以内に空き接続を取得できませんでした (max_size={self.max_size})")
+                waited = True
+                self._cond.wait(remaining)
+
+            wait_seconds = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            self._stats['total_wait_seconds'] += wait_seconds
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], wait_seconds)
+            if waited:
+                self._stats['waited_checkouts'] += 1
+            self._waits.append(wait_seconds)
+
+        try:
+            conn = self._prepare(conn)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        conn.pool = self
+        conn.checked_out = True
+        return conn
+
+    def putconn(self, conn: PooledConnection):
+        if not conn.checked_out:
+            return
+        conn.checked_out = False
+        discard = conn.closed or self._closed or os.getpid() != self.pid
+        if not discard:
+            try:
+                # 呼び出し側がコミットし忘れたトランザクションは破棄してから返却する
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        now = time.monotonic()
+        if not discard and self._is_expired(conn, now):
+            discard = True
+            with self._cond:
+                self._stats['connections_recycled'] += 1
+
+        if discard:
+            conn.close_physical()
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+
+        conn.last_used_at = now
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close_physical()
+
+    def stats(self) -> dict:
+        """プールの待ち時間メトリクス（サイジング用）"""
+        with self._cond:
+            stats = dict(self._stats)
+            waits = sorted(self._waits)
+            stats.update({
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+            })
+        checkouts = stats['checkouts']
+        stats['avg_wait_seconds'] = stats['total_wait_seconds'] / checkouts if checkouts else 0.0
+        stats['p50_wait_seconds'] = waits[len(waits) // 2] if waits else 0.0
+        stats['p95_wait_seconds'] = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+        return stats
+
+def execute_prepared(cursor, name: str, sql: str, params: tuple):
+    """
+    サーバー側のプリペアドステートメントとして実行する（プールの接続専用）。
+    PREPARE は物理接続ごとに初回だけ行い、以降は EXECUTE のみ送る。sql 中のパラメータは $1, $2, ... で書く。
+    """
+    conn = cursor.connection
+    if name not in conn.prepared_statements:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared_statements.add(name)
+    placeholders = ', '.join(['%s'] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+# --- プロセス単位のシングルトン ---
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """現在のプロセス用のプールを返す（fork後のワーカーでは新しく作り直す）"""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            # fork元から引き継いだ接続はソケットを共有しているため触らずに捨てる
+            _pool = ConnectionPool()
+        return _pool
+
+@contextmanager
+def connection():
+    """with 文で使う貸出用ヘルパー。ブロックを抜けると接続はプールへ返却される"""
+    conn = get_pool().getconn()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.close()
+        _pool = None
+
+def get_pool_stats() -> dict:
+    return get_pool().stats()
@@ -0,0 +1,149 @@
+# embedding_cache.py
+# 埋め込みを (正規化した本文のハッシュ, 埋め込みモデル) をキーに embedding_cache テーブルへ保存し、使い回す。
+# 同じ本文・同じモデルの埋め込みは変わらないので、分類だけをやり直す場合（プロンプト変更後の再分析や
+# analysis/run_experiment.py の再実行）に埋め込みを取り直さなくて済む。
+# Webの経路（非同期）と analysis/ のスクリプト（同期）の両方が、llm_analyzer.embedder 経由でこれを使う。
+
+import os
+import threading
+
+try:
+    import async_database
+    import database
+    import embedding_provider
+    import text_hash
+except ImportError:
+    from app import async_database
+    from app import database
+    from app import embedding_provider
+    from app import text_hash
+
+ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', '1') == '1'
+
+class EmbeddingCacheStats:
+    """埋め込みキャッシュのヒット率（プロセス単位）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.errors = 0    # キャッシュの読み書きに失敗した回数（失敗しても埋め込みは取得する）
+
+    def record(self, hits: int = 0, misses: int = 0, stored: int = 0, errors: int = 0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.stored += stored
+            self.errors += errors
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stored': self.stored,
+                'errors': self.errors,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+cache_stats = EmbeddingCacheStats()
+
+class CachedEmbeddingProvider(embedding_provider.EmbeddingProvider):
+    """別の埋め込みバックエンドの前に置き、キャッシュに無い本文（同じ本文は1回だけ）を渡す"""
+
+    def __init__(self, inner: embedding_provider.EmbeddingProvider):
+        self.inner = inner
+        self.name = inner.name
+        self.model_id = inner.model_id
+        self.dimension = inner.dimension
+        self.batch_size = inner.batch_size
+
+    def warm_up(self):
+        self.inner.warm_up()
+
+    def _plan(self, texts: list[str]) -> tuple[list, dict]:
+        """各本文のハッシュと、ハッシュ → 最初に現れた位置"""
+        hashes = [text_hash.text_hash(text) for text in texts]
+        first = {}
+        for i, h in enumerate(hashes):
+            if h is not None:
+                first.setdefault(h, i)
+        return hashes, first
+
+    def _fill(self, hashes: list, first: dict, cached: dict) -> tuple[list, list[int]]:
+        """キャッシュにあった埋め込みを埋め、バックエンドに渡す位置（ハッシュが無いもの＋ミスの最初の位置）を返す"""
+        embeddings = [cached.get(h) if h is not None else None for h in hashes]
+        missing, seen = [], set()
+        for i, h in enumerate(hashes):
+            if embeddings[i] is not None:
+                continue
+            if h is None:
+                missing.append(i)
+            elif h not in seen:
+                seen.add(h)
+                missing.append(i)
+        # 同じバッチ内で重複する本文は1件として数える
+        cache_stats.record(hits=sum(1 for h in first if h in cached), misses=len(seen))
+        return embeddings, missing
+
+    def _merge(self, embeddings: list, hashes: list, missing: list[int], computed: list) -> list[tuple]:
+        """計算した埋め込みを同じハッシュの全ての位置に入れ、新しく保存する (ハッシュ, 埋め込み) を返す"""
+        by_hash, new_rows = {}, []
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding
+            if hashes[i] is not None and embedding is not None:
+                by_hash[hashes[i]] = embedding
+                new_rows.append((hashes[i], embedding))
+        for i, h in enumerate(hashes):
+            if embeddings[i] is None and h in by_hash:
+                embeddings[i] = by_hash[h]
+        return new_rows
+
+    def embed(self, texts: list[str]) -> list:
+        hashes, first = self._plan(texts)
+        try:
+            cached = database.get_cached_embeddings(list(first), self.model_id) if first else {}
+        except Exception as e:
+            print(f"⚠️ 埋め込みキャッシュの参照に失敗しました: {e}")
+            cache_stats.record(errors=1)
+            cached = {}
+        embeddings, missing = self._fill(hashes, first, cached)
+        if not missing:
+            return embeddings
+        computed = self.inner.embed([texts[i] for i in missing])
+        new_rows = self._merge(embeddings, hashes, missing, computed)
+        if new_rows:
+            try:
+                cache_stats.record(stored=database.save_cached_embeddings(new_rows, self.model_id))
+            except Exception as e:
+                print(f"⚠️ 埋め込みキャッシュの保存に失敗しました: {e}")
+                cache_stats.record(errors=1)
+        return embeddings
+
+    async def embed_async(self, texts: list[str]) -> list:
+        hashes, first = self._plan(texts)
+        try:
+            cached = await async_database.get_cached_embeddings(list(first), self.model_id) if first else {}
+        except Exception as e:
+            print(f"⚠️ 埋め込みキャッシュの参照に失敗しました: {e}")
+            cache_stats.record(errors=1)
+            cached = {}
+        embeddings, missing = self._fill(hashes, first, cached)
+        if not missing:
+            return embeddings
+        computed = await self.inner.embed_async([texts[i] for i in missing])
+        new_rows = self._merge(embeddings, hashes, missing, computed)
+        if new_rows:
+            try:
+                cache_stats.record(stored=await async_database.save_cached_embeddings(new_rows, self.model_id))
+            except Exception as e:
+                print(f"⚠️ 埋め込みキャッシュの保存に失敗しました: {e}")
+                cache_stats.record(errors=1)
+        return embeddings
+
+    def stats(self) -> dict:
+        stats = self.inner.stats()
+        stats['cache'] = cache_stats.stats()
+        return stats
@@ -0,0 +1,172 @@
+# embedding_provider.py
+# 投稿本文の埋め込みを計算するバックエンド。EMBEDDING_PROVIDER で切り替える。
+#   - gemini: text-embedding-004。APIキーのレート制限を分類と共有する（実装は llm_analyzer.GeminiEmbeddingProvider）
+#   - local : sentence-transformers の多言語モデルを CPU で実行する。APIの枠も通信も使わない
+# どのモデルで計算した埋め込みかは post_analysis_cache の embedding_model / embedding_dim に保存し、
+# 類似判定では現在のモデルで計算した埋め込み同士だけを比較する（モデルが違うベクトルは比較できない）。
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PROVIDER = os.getenv('EMBEDDING_PROVIDER', 'gemini')
+
+GEMINI_MODEL = "models/text-embedding-004"
+GEMINI_DIMENSION = 768
+
+# 日本語を含む多言語対応で、既存の列 (halfvec(768)) と同じ768次元のモデルを既定にしている
+LOCAL_MODEL = os.getenv('LOCAL_EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2')
+LOCAL_BACKEND = os.getenv('LOCAL_EMBEDDING_BACKEND', 'torch')         # torch / onnx / openvino
+LOCAL_MODEL_FILE = os.getenv('LOCAL_EMBEDDING_MODEL_FILE')            # 例: onnx/model_qint8_avx512_vnni.onnx（量子化済みのONNX）
+LOCAL_QUANTIZE = os.getenv('LOCAL_EMBEDDING_QUANTIZE', '0') == '1'    # torch の場合に Linear 層を int8 に動的量子化する
+LOCAL_TOKEN_BUDGET = int(os.getenv('LOCAL_EMBEDDING_TOKEN_BUDGET', '8192'))  # 1回の推論に載せるトークン数（パディング込み）
+LOCAL_MAX_BATCH = int(os.getenv('LOCAL_EMBEDDING_MAX_BATCH', '128'))
+LOCAL_THREADS = int(os.getenv('LOCAL_EMBEDDING_THREADS', '0'))        # 0 なら torch の既定（物理コア数）
+
+# post_analysis_cache.embedding の次元数（migrations の version 4）
+COLUMN_DIMENSION = 768
+
+# 現在の設定で保存・比較に使うモデルの識別子（モデルを読み込まなくても決まる）
+MODEL_ID = LOCAL_MODEL if PROVIDER == 'local' else GEMINI_MODEL
+
+class EmbeddingProvider:
+    """埋め込みバックエンドの共通インターフェース。空の本文・失敗した投稿の位置には None を返す"""
+
+    name = None
+    model_id = None
+    dimension = None
+    batch_size = 100   # まとめ処理 (analysis_coalescer) で1回に渡す本文の件数の目安
+
+    def warm_up(self):
+        """起動時に呼ぶ。モデルの読み込み等、最初の呼び出しを遅くする準備をここで済ませる"""
+
+    def embed(self, texts: list[str]) -> list:
+        raise NotImplementedError
+
+    async def embed_async(self, texts: list[str]) -> list:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {'provider': self.name, 'model': self.model_id, 'dimension': self.dimension, 'batch_size': self.batch_size}
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    sentence-transformers のモデルを CPU で実行する。
+    本文をトークン数の近いもの同士でまとめ、パディング込みのトークン数が予算に収まる大きさで推論する
+    （短い投稿は大きなバッチ、長い投稿は小さなバッチになる）。
+    """
+
+    name = 'local'
+
+    def __init__(self, model_id: str = LOCAL_MODEL, backend: str = LOCAL_BACKEND, model_file: str | None = LOCAL_MODEL_FILE,
+                 quantize: bool = LOCAL_QUANTIZE, token_budget: int = LOCAL_TOKEN_BUDGET, max_batch: int = LOCAL_MAX_BATCH):
+        self.model_id = model_id
+        self.dimension = COLUMN_DIMENSION
+        self.backend = backend
+        self.model_file = model_file
+        self.quantize = quantize
+        self.token_budget = token_budget
+        self.batch_size = max_batch
+        self._model = None
+        self._lock = threading.Lock()
+        # CPU推論は torch / onnxruntime の中で並列化されるので、呼び出し自体は1本のスレッドで順番に実行する
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='local-embedding')
+        self._stats = {'calls': 0, 'texts': 0, 'forward_passes': 0, 'padded_tokens': 0, 'seconds': 0.0, 'errors': 0}
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load()
+        return self._model
+
+    def _load(self):
+        # torch を読み込むだけで数秒かかるため、ローカル埋め込みを使う場合だけ import する
+        from sentence_transformers import SentenceTransformer
+
+        start = time.monotonic()
+        kwargs = {'device': 'cpu'}
+        if self.backend != 'torch':
+            kwargs['backend'] = self.backend
+            if self.model_file:
+                kwargs['model_kwargs'] = {'file_name': self.model_file}
+        model = SentenceTransformer(self.model_id, **kwargs)
+        if self.backend == 'torch':
+            import torch
+            if LOCAL_THREADS:
+                torch.set_num_threads(LOCAL_THREADS)
+            if self.quantize:
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        dimension = model.get_sentence_embedding_dimension()
+        if dimension != COLUMN_DIMENSION:
+            raise ValueError(f"埋め込みの次元数 ({dimension}) が post_analysis_cache.embedding の次元数 ({COLUMN_DIMENSION}) と一致しません")
+        self.dimension = dimension
+        print(f"🧠 埋め込みモデル {self.model_id} を読み込みました ({self.backend}{', int8' if self.quantize else ''}, {dimension}次元, {time.monotonic() - start:.1f}秒)")
+        return model
+
+    def warm_up(self):
+        try:
+            self.model
+        except Exception as e:
+            print(f"❌ 埋め込みモデルの読み込みに失敗しました: {e}")
+
+    def _batches(self, lengths: list[int]) -> list[list[int]]:
+        """長い順に並べて先頭から詰める。バッチの幅（最長の本文のトークン数）× 件数が予算を超えたら次のバッチにする"""
+        order = sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True)
+        batches, batch = [], []
+        for i in order:
+            if batch:
+                width = lengths[batch[0]]
+                if len(batch) >= self.batch_size or (len(batch) + 1) * width > self.token_budget:
+                    batches.append(batch)
+                    batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed(self, texts: list[str]) -> list:
+        embeddings = [None] * len(texts)
+        valid_indices = [i for i, t in enumerate(texts) if t and t.strip()]
+        if not valid_indices:
+            return embeddings
+        valid_texts = [texts[i] for i in valid_indices]
+
+        start = time.monotonic()
+        try:
+            model = self.model
+            lengths = [len(ids) for ids in model.tokenizer(valid_texts, truncation=True, max_length=model.max_seq_length)['input_ids']]
+            for batch in self._batches(lengths):
+                vectors = model.encode(
+                    [valid_texts[i] for i in batch], batch_size=len(batch),
+                    normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False,
+                )
+                for i, vector in zip(batch, vectors):
+                    embeddings[valid_indices[i]] = vector.tolist()
+                self._stats['forward_passes'] += 1
+                self._stats['padded_tokens'] += lengths[batch[0]] * len(batch)
+        except Exception as e:
+            self._stats['errors'] += 1
+            print(f"Local Embedding Error: {e}")
+        self._stats['calls'] += 1
+        self._stats['texts'] += len(valid_texts)
+        self._stats['seconds'] += time.monotonic() - start
+        return embeddings
+
+    async def embed_async(self, texts: list[str]) -> list:
+        # CPU を使う処理なのでイベントループを止めないよう専用スレッドで実行する
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.embed, texts)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update(self._stats)
+        stats.update({
+            'backend': self.backend,
+            'quantized': self.quantize,
+            'loaded': self._model is not None,
+            'texts_per_second': self._stats['texts'] / self._stats['seconds'] if self._stats['seconds'] else 0.0,
+        })
+        return stats
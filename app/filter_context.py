@@ -0,0 +1,148 @@
+# filter_context.py
+# フィルタリングに必要なユーザー情報（設定・最新のHEXACOスコア・不快報告）を1回のクエリでまとめて取得する。
+# 同期版 (database.py) と非同期版 (async_database.py) の両方から使う。
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+try:
+    import similarity
+except ImportError:
+    from app import similarity
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.80
+DEFAULT_FILTER_STRENGTH = 2
+
+# ワーカープロセス内のキャッシュ設定。別ワーカーでの更新はTTLが切れるまで反映されない
+CONTEXT_CACHE_TTL = float(os.getenv('FILTER_CONTEXT_CACHE_TTL', '60'))
+CONTEXT_CACHE_MAX_USERS = int(os.getenv('FILTER_CONTEXT_CACHE_MAX_USERS', '5000'))
+
+# プレースホルダーは同期版が %s、非同期版が $1 なので、{param} を差し替えて使う
+# 報告済みベクトルは現在の埋め込みモデル ({model}) で計算したものだけを返す
+USER_FILTER_CONTEXT_QUERY = """
+WITH target AS (SELECT {param}::text AS user_did)
+SELECT
+    (SELECT row_to_json(s)::text FROM (
+        SELECT fs.hidden_content_categories, fs.auto_filter_enabled, fs.similarity_filter_enabled,
+               fs.filter_strength, fs.similarity_threshold
+        FROM filter_settings AS fs JOIN target ON fs.user_did = target.user_did
+    ) AS s) AS settings,
+    (SELECT row_to_json(r)::text FROM (
+        SELECT hr.h, hr.e, hr.x, hr.a, hr.c, hr.o
+        FROM hexaco_results AS hr JOIN target ON hr.user_did = target.user_did
+        ORDER BY hr.diagnosed_at DESC LIMIT 1
+    ) AS r) AS scores,
+    ARRAY(
+        SELECT feedback.post_uri
+        FROM unpleasant_feedback AS feedback JOIN target ON feedback.user_did = target.user_did
+    ) AS unpleasant_uris,
+    ARRAY(
+        SELECT cache.embedding::real[]
+        FROM unpleasant_feedback AS feedback
+        JOIN target ON feedback.user_did = target.user_did
+        JOIN post_analysis_cache AS cache ON feedback.post_uri = cache.post_uri
+        WHERE cache.embedding IS NOT NULL AND cache.embedding_model = {model}
+    ) AS unpleasant_vectors
+"""
+
+@dataclass(frozen=True)
+class UserFilterContext:
+    """1リクエストのフィルタリングで参照するユーザー情報"""
+    hidden_content_categories: frozenset
+    auto_filter_enabled: bool
+    similarity_filter_enabled: bool
+    filter_strength: int
+    similarity_threshold: float
+    scores: dict | None               # {'h': 3.2, 'e': ...} 未診断なら None
+    unpleasant_uris: frozenset
+    unpleasant_vectors: np.ndarray    # (報告数, 次元数) のL2正規化済み float32 行列
+
+def _load_json(value):
+    if value is None:
+        return None
+    return json.loads(value) if isinstance(value, str) else value
+
+def build_user_filter_context(row) -> UserFilterContext:
+    """USER_FILTER_CONTEXT_QUERY の結果行から UserFilterContext を組み立てる"""
+    settings = _load_json(row['settings']) or {}
+    # 類似判定で毎回正規化しなくて済むよう、読み込み時にL2正規化しておく
+    unpleasant_vectors = similarity.normalize_rows(row['unpleasant_vectors'] or [])
+    return UserFilterContext(
+        hidden_content_categories=frozenset(settings.get('hidden_content_categories') or []),
+        auto_filter_enabled=settings.get('auto_filter_enabled', True),
+        similarity_filter_enabled=settings.get('similarity_filter_enabled', True),
+        filter_strength=settings.get('filter_strength', DEFAULT_FILTER_STRENGTH),
+        similarity_threshold=settings.get('similarity_threshold', DEFAULT_SIMILARITY_THRESHOLD),
+        scores=_load_json(row['scores']),
+        unpleasant_uris=frozenset(row['unpleasant_uris'] or []),
+        unpleasant_vectors=unpleasant_vectors,
+    )
+
+class UserFilterContextCache:
+    """
+    ユーザーごとの UserFilterContext をメモリに保持する。
+    設定・報告・診断結果が更新されるとバージョンを進め、古いエントリは使わない。
+    読み込み開始時のバージョンと一致する場合のみ保存するため、読み込み中に更新が入っても古い値は残らない。
+    """
+
+    def __init__(self, ttl: float = CONTEXT_CACHE_TTL, max_users: int = CONTEXT_CACHE_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._versions = {}            # user_did -> バージョン
+        self._entries = OrderedDict()  # user_did -> (バージョン, 有効期限, コンテキスト)
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, user_did: str) -> int:
+        with self._lock:
+            return self._versions.get(user_did, 0)
+
+    def get(self, user_did: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_did)
+            if entry is not None:
+                version, expires_at, context = entry
+                if version == self._versions.get(user_did, 0) and now < expires_at:
+                    self._entries.move_to_end(user_did)
+                    self.hits += 1
+                    return context
+                del self._entries[user_did]
+            self.misses += 1
+            return None
+
+    def put(self, user_did: str, version: int, context: UserFilterContext):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if version != self._versions.get(user_did, 0):
+                return
+            self._entries[user_did] = (version, time.monotonic() + self.ttl, context)
+            self._entries.move_to_end(user_did)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_did: str):
+        with self._lock:
+            self._versions[user_did] = self._versions.get(user_did, 0) + 1
+            self._entries.pop(user_did, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'ttl_seconds': self.ttl,
+            }
+
+context_cache = UserFilterContextCache()
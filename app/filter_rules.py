@@ -0,0 +1,150 @@
+# filter_rules.py
+# personality_descriptions.FILTERING_RULES を起動時に「性格プロファイル × 強さ」ごとの表へ展開する。
+# プロファイルは6因子それぞれの high/low を1ビットで表した 0〜63 の整数。
+# 各軸のカテゴリにはコード番号を振り、非表示にするカテゴリの集合を整数ビットマスクで持つ。
+
+import numpy as np
+
+try:
+    import personality_descriptions
+except ImportError:
+    from app import personality_descriptions
+
+TRAITS = list(personality_descriptions.FILTERING_RULES.keys())   # ['H', 'E', 'X', 'A', 'C', 'O']
+STRENGTHS = (1, 2, 3)
+AXES = ('content', 'expression', 'style')
+AXIS_KEYS = {
+    'content': 'content_category',
+    'expression': 'expression_category',
+    'style': 'style_stance_category',
+}
+HIGH_THRESHOLD = 3.0
+
+def _build_category_codes() -> dict[str, dict[str, int]]:
+    """ルールに登場するカテゴリに軸ごとの連番を振る（登場しないカテゴリは非表示にならない）"""
+    codes = {axis: {} for axis in AXES}
+    for rules_by_level in personality_descriptions.FILTERING_RULES.values():
+        for level in ('high', 'low'):
+            for rule in rules_by_level.get(level, []):
+                axis_codes = codes[rule['type']]
+                for categories in rule['categories'].values():
+                    for category in categories:
+                        axis_codes.setdefault(category, len(axis_codes))
+    for axis, axis_codes in codes.items():
+        assert len(axis_codes) < 64, f"{axis} のカテゴリ数がビットマスクの上限を超えています"
+    return codes
+
+CATEGORY_CODES = _build_category_codes()
+NO_CODE = -1
+
+def profile_of(scores: dict | None) -> int:
+    """HEXACOスコアからプロファイル番号を求める（ビットi = TRAITS[i] が high）"""
+    if not scores:
+        return 0
+    profile = 0
+    for i, trait in enumerate(TRAITS):
+        if scores.get(trait.lower(), 0) >= HIGH_THRESHOLD:
+            profile |= 1 << i
+    return profile
+
+def _compile(profile: int, strength: int):
+    """
+    1つの (プロファイル, 強さ) について、
+    - steps: 元のルール走査順に並べた (軸, ビットマスク) のリスト（どのカテゴリで隠したかの判定用）
+    - masks: 軸ごとに統合したビットマスク
+    - hidden: 軸ごとの非表示カテゴリ集合
+    - active_rules: 設定画面に表示する {フィルター名: [カテゴリ, ...]}
+    を作る。
+    """
+    steps = []
+    masks = {axis: 0 for axis in AXES}
+    hidden = {axis: [] for axis in AXES}
+    active_rules = {}
+    for i, (trait, rules_by_level) in enumerate(personality_descriptions.FILTERING_RULES.items()):
+        level = 'high' if profile & (1 << i) else 'low'
+        merged = []
+        for rule in rules_by_level.get(level, []):
+            axis = rule['type']
+            categories = rule['categories'].get(strength, [])
+            mask = 0
+            for category in categories:
+                mask |= 1 << CATEGORY_CODES[axis][category]
+                if category not in hidden[axis]:
+                    hidden[axis].append(category)
+                if category not in merged:
+                    merged.append(category)
+            if mask:
+                steps.append((axis, mask))
+                masks[axis] |= mask
+        if merged:
+            active_rules[rules_by_level['name']] = merged
+    return {
+        'steps': tuple(steps),
+        'masks': masks,
+        'hidden': {axis: frozenset(categories) for axis, categories in hidden.items()},
+        'active_rules': active_rules,
+    }
+
+COMPILED_RULES = {
+    (profile, strength): _compile(profile, strength)
+    for profile in range(2 ** len(TRAITS))
+    for strength in STRENGTHS
+}
+_EMPTY_RULES = _compile(0, None)
+
+def _rules_for(profile: int, strength: int) -> dict:
+    return COMPILED_RULES.get((profile, strength), _EMPTY_RULES)
+
+def hidden_categories(scores: dict | None, strength: int) -> dict[str, frozenset]:
+    """軸ごとの非表示カテゴリ集合"""
+    return _rules_for(profile_of(scores), strength)['hidden']
+
+def active_rules(scores: dict | None, strength: int) -> dict[str, list[str]]:
+    """設定画面用: 有効になっているフィルター名とカテゴリ"""
+    if not scores:
+        return {}
+    return _rules_for(profile_of(scores), strength)['active_rules']
+
+def _code(axis: str, category) -> int:
+    return CATEGORY_CODES[axis].get(category, NO_CODE)
+
+def match(analysis_result: dict, scores: dict | None, strength: int):
+    """1件の分析結果について、性格診断フィルターで隠すべきならそのカテゴリ名を返す"""
+    if not analysis_result or not scores:
+        return None
+    for axis, mask in _rules_for(profile_of(scores), strength)['steps']:
+        category = analysis_result.get(AXIS_KEYS[axis])
+        code = _code(axis, category)
+        if code != NO_CODE and mask >> code & 1:
+            return category
+    return None
+
+def page_matches(uris: list[str], analysis_results: list, scores: dict | None, strength: int) -> dict[str, str]:
+    """
+    1ページ分の分析結果をまとめて判定し、隠すべき投稿の {URI: カテゴリ名} を返す。
+    軸ごとのカテゴリコード配列に対してビットマスクを引くだけなので、ページ全体がベクトル演算になる。
+    """
+    if not scores or not uris:
+        return {}
+    steps = _rules_for(profile_of(scores), strength)['steps']
+    if not steps:
+        return {}
+
+    codes = {
+        axis: np.array([_code(axis, result.get(AXIS_KEYS[axis])) if result else NO_CODE for result in analysis_results], dtype=np.int64)
+        for axis in AXES
+    }
+    # 最初に一致したルールの軸を記録する（-1 は一致なし）
+    matched_axis = np.full(len(uris), -1, dtype=np.int64)
+    for axis, mask in steps:
+        axis_codes = codes[axis]
+        valid = axis_codes != NO_CODE
+        hit = np.zeros(len(uris), dtype=bool)
+        hit[valid] = ((np.uint64(mask) >> axis_codes[valid].astype(np.uint64)) & np.uint64(1)) == 1
+        matched_axis[hit & (matched_axis == -1)] = AXES.index(axis)
+
+    matches = {}
+    for i in np.flatnonzero(matched_axis >= 0):
+        axis = AXES[matched_axis[i]]
+        matches[uris[i]] = analysis_results[i].get(AXIS_KEYS[axis])
+    return matches
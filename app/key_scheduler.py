@@ -0,0 +1,244 @@
+# key_scheduler.py
+# Gemini APIキーのプール。キーごとにクライアント・レート制限（RPM/TPM のトークンバケット）・クールダウンを持ち、
+# 呼び出しのたびに「今すぐ使える中で最も空いているキー」を割り当てる。
+# グローバルな genai.configure() を切り替える方式と違い、並行するリクエスト同士でキーの状態が競合しない。
+
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import google.generativeai as genai
+from google.api_core import exceptions
+from google.generativeai import client as genai_client
+
+GENERATION_MODEL = 'gemini-2.5-flash'
+
+# 呼び出しの種類ごとのキー1本あたりの上限（無料枠の値を既定値にしている）
+LIMITS = {
+    'generate': (int(os.getenv('GEMINI_KEY_RPM', '10')), int(os.getenv('GEMINI_KEY_TPM', '250000'))),
+    'embed': (int(os.getenv('GEMINI_KEY_EMBED_RPM', '1500')), int(os.getenv('GEMINI_KEY_EMBED_TPM', '1000000'))),
+}
+COOLDOWN_BASE = float(os.getenv('GEMINI_KEY_COOLDOWN_BASE', '5'))    # 429を受けたキーを休ませる時間（連続するたびに倍）
+COOLDOWN_MAX = float(os.getenv('GEMINI_KEY_COOLDOWN_MAX', '60'))
+ACQUIRE_TIMEOUT = float(os.getenv('GEMINI_KEY_WAIT_TIMEOUT', '60'))  # 使えるキーが空くまで待つ上限（秒）
+
+class NoAvailableKey(Exception):
+    """待ち時間内に使えるAPIキーが無かった（全キーが無効・クールダウン中・上限到達）"""
+
+class TokenBucket:
+    """1分あたり capacity を上限に連続的に補充されるバケット"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.rate = capacity / 60.0
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """amount を取り出せるようになるまでの秒数（0 なら今すぐ取り出せる）"""
+        self._refill(now)
+        amount = min(amount, self.capacity)  # 上限より大きい要求はバケットが満杯になれば通す
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+class _Lane:
+    """1つのキーの、呼び出しの種類ごとのレート制限状態"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.cooldown_until = 0.0
+        self.strikes = 0      # 連続した429の回数
+        self.in_flight = 0
+        self.calls = 0
+        self.rate_limited = 0
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        return max(self.cooldown_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+class ApiKey:
+    """1本のAPIキーと、そのキー専用のクライアント"""
+
+    def __init__(self, index: int, key: str):
+        self.index = index
+        self.key = key
+        self.masked = f"{key[:4]}...{key[-4:]}" if len(key) > 8 else "***"
+        self.disabled = False
+        self.lanes = {kind: _Lane(rpm, tpm) for kind, (rpm, tpm) in LIMITS.items()}
+        self._clients = genai_client._ClientManager()
+        self._clients.configure(api_key=key)
+        self._model = None
+        self._async_model = None
+
+    @property
+    def client(self):
+        return self._clients.get_default_client('generative')
+
+    @property
+    def async_client(self):
+        # grpc の非同期チャネルはイベントループ内で作る必要があるため、初回使用時に生成する
+        return self._clients.get_default_client('generative_async')
+
+    # GenerativeModel は既定では genai.configure() の共有クライアントを使うので、このキーのものに差し替える。
+    # _ClientManager・_client・_async_client はライブラリ内部の属性なので、requirements.txt でバージョンを固定し、
+    # tests/test_key_scheduler.py で差し替えたクライアントが実際に使われることを確かめている
+    @property
+    def model(self) -> genai.GenerativeModel:
+        if self._model is None:
+            self._model = genai.GenerativeModel(GENERATION_MODEL)
+            self._model._client = self.client
+        return self._model
+
+    @property
+    def async_model(self) -> genai.GenerativeModel:
+        if self._async_model is None:
+            self._async_model = genai.GenerativeModel(GENERATION_MODEL)
+            self._async_model._async_client = self.async_client
+        return self._async_model
+
+    def embed_content(self, **kwargs):
+        return genai.embed_content(client=self.client, **kwargs)
+
+    async def embed_content_async(self, **kwargs):
+        return await genai.embed_content_async(client=self.async_client, **kwargs)
+
+class KeyScheduler:
+    def __init__(self, keys: list[str]):
+        self.keys = [ApiKey(i, key) for i, key in enumerate(keys)]
+        self._lock = threading.Lock()
+        for api_key in self.keys:
+            print(f"GenAI Key [{api_key.index + 1}/{len(self.keys)}] を登録しました: {api_key.masked}")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _try_acquire(self, kind: str, tokens: int):
+        """
+        今すぐ使えるキーがあれば枠を消費して (キー, 0) を返し、無ければ (None, 次に空くまでの秒数) を返す。
+        使えるキーの中では処理中の呼び出しが最も少ないもの（同数ならトークンの残りが多いもの）を選ぶ。
+        """
+        now = time.monotonic()
+        with self._lock:
+            best, best_rank, next_ready = None, None, None
+            for api_key in self.keys:
+                if api_key.disabled:
+                    continue
+                lane = api_key.lanes[kind]
+                wait = lane.wait_time(tokens, now)
+                if wait > 0:
+                    next_ready = wait if next_ready is None else min(next_ready, wait)
+                    continue
+                rank = (lane.in_flight, -lane.tokens.tokens, api_key.index)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = api_key, rank
+            if best is None:
+                if next_ready is None:
+                    raise NoAvailableKey("有効なAPIキーがありません")
+                return None, next_ready
+            lane = best.lanes[kind]
+            lane.requests.take(1)
+            lane.tokens.take(tokens)
+            lane.in_flight += 1
+            lane.calls += 1
+            return best, 0.0
+
+    def _release(self, api_key: ApiKey, kind: str, error: Exception | None):
+        with self._lock:
+            lane = api_key.lanes[kind]
+            lane.in_flight -= 1
+            if isinstance(error, exceptions.ResourceExhausted):
+                lane.strikes += 1
+                lane.rate_limited += 1
+                cooldown = min(COOLDOWN_MAX, COOLDOWN_BASE * (2 ** (lane.strikes - 1)))
+                # 同じ瞬間に429を受けたキーが一斉に復帰しないようにばらつかせる
+                lane.cooldown_until = time.monotonic() + random.uniform(cooldown / 2, cooldown)
+                print(f"⚠️ APIキー [{api_key.index + 1}] が {kind} の上限に達しました。約{cooldown:.0f}秒休ませます。")
+            elif error is not None and is_invalid_key_error(error):
+                api_key.disabled = True
+                print(f"❌ APIキー [{api_key.index + 1}] は無効なため、以降使用しません。")
+            elif error is None:
+                lane.strikes = 0
+
+    @contextmanager
+    def lease(self, kind: str, tokens: int = 0, timeout: float = ACQUIRE_TIMEOUT):
+        """with 文の間だけキーを1本借りる。ブロック内で起きた429・無効キーのエラーはキーの状態に反映して再送出する"""
+        deadline = time.monotonic() + timeout
+        while True:
+            api_key, wait = self._try_acquire(kind, tokens)
+            if api_key is not None:
+                break
+            if time.monotonic() + wait > deadline:
+                raise NoAvailableKey(f"{timeout}秒以内に使用可能なAPIキーがありませんでした ({kind})")
+            time.sleep(wait)
+        try:
+            yield api_key
+        except Exception as e:
+            self._release(api_key, kind, e)
+            raise
+        self._release(api_key, kind, None)
+
+    @asynccontextmanager
+    async def lease_async(self, kind: str, tokens: int = 0, timeout: float = ACQUIRE_TIMEOUT):
+        """lease の asyncio 版。空きを待つ間もイベントループを止めない"""
+        deadline = time.monotonic() + timeout
+        while True:
+            api_key, wait = self._try_acquire(kind, tokens)
+            if api_key is not None:
+                break
+            if time.monotonic() + wait > deadline:
+                raise NoAvailableKey(f"{timeout}秒以内に使用可能なAPIキーがありませんでした ({kind})")
+            await asyncio.sleep(wait)
+        try:
+            yield api_key
+        except BaseException as e:
+            self._release(api_key, kind, e if isinstance(e, Exception) else None)
+            raise
+        self._release(api_key, kind, None)
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    'index': api_key.index,
+                    'disabled': api_key.disabled,
+                    **{
+                        kind: {
+                            'calls': lane.calls,
+                            'rate_limited': lane.rate_limited,
+                            'in_flight': lane.in_flight,
+                            'cooldown_seconds': max(0.0, lane.cooldown_until - now),
+                            'requests_available': round(lane.requests.tokens, 1),
+                            'tokens_available': int(lane.tokens.tokens),
+                        }
+                        for kind, lane in api_key.lanes.items()
+                    },
+                }
+                for api_key in self.keys
+            ]
+
+# キー自体が使えないことを示す ErrorInfo の reason
+INVALID_KEY_REASONS = {'API_KEY_INVALID', 'API_KEY_EXPIRED'}
+INVALID_KEY_ERRORS = (exceptions.InvalidArgument, exceptions.PermissionDenied, exceptions.Unauthenticated)
+
+def is_invalid_key_error(e: Exception) -> bool:
+    """
+    APIキーが無効・期限切れのエラーか（別のキーで再試行し、このキーは以降使わない）。
+    ステータスと ErrorInfo の reason で判定し、通常の 400（リクエストの内容の誤り）はキーの問題として扱わない。
+    """
+    if not isinstance(e, INVALID_KEY_ERRORS):
+        return False
+    if getattr(e, 'reason', None) in INVALID_KEY_REASONS:
+        return True
+    # ErrorInfo が付かない応答では、APIが返す定型のメッセージで判定する
+    message = str(e)
+    return 'API_KEY_INVALID' in message or 'API key not valid' in message or 'API key expired' in message
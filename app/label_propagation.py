@@ -0,0 +1,71 @@
+# label_propagation.py
+# 新しい投稿の埋め込みに近い、LLMが分類済みの投稿を post_analysis_cache から pgvector (HNSW) で探し、
+# 類似度が閾値以上の近傍のカテゴリが全て一致していれば、そのカテゴリを分類プロンプトに送らずに使う。
+# ニュースの見出し・ミーム・botの言い換えのように、本文は少し違うが分類は同じになる投稿が対象。
+# 伝播したラベルは label_source = 'knn' として保存し、近傍の候補にはLLMが付けたラベルだけを使う
+# （伝播したラベルからさらに伝播して誤りが広がらないように）。
+
+import os
+
+try:
+    import async_database
+except ImportError:
+    from app import async_database
+
+ENABLED = os.getenv('KNN_LABELS_ENABLED', '0') == '1'
+K = int(os.getenv('KNN_LABELS_K', '5'))
+MIN_SIMILARITY = float(os.getenv('KNN_LABELS_MIN_SIMILARITY', '0.95'))   # この類似度以上の近傍だけを数える
+MIN_NEIGHBORS = int(os.getenv('KNN_LABELS_MIN_NEIGHBORS', '2'))          # 一致している近傍がこの件数以上なら使う
+BATCH_SIZE = int(os.getenv('KNN_LABELS_BATCH_SIZE', '50'))               # 1回のクエリで近傍を探す投稿数
+
+AXES = ("content_category", "expression_category", "style_stance_category")
+LABEL_SOURCE = 'knn'
+
+class LabelPropagator:
+    def __init__(self, enabled: bool = ENABLED, k: int = K, min_similarity: float = MIN_SIMILARITY,
+                 min_neighbors: int = MIN_NEIGHBORS):
+        self.enabled = enabled
+        self.k = k
+        self.min_similarity = min_similarity
+        self.min_neighbors = min_neighbors
+        self._stats = {'lookups': 0, 'propagated': 0, 'too_few_neighbors': 0, 'disagreements': 0}
+
+    def vote(self, neighbors: list[dict]) -> dict | None:
+        """閾値以上の近傍が min_neighbors 件以上あり、3軸とも一致していればそのカテゴリを返す"""
+        close = [neighbor for neighbor in neighbors if neighbor['similarity'] >= self.min_similarity]
+        if len(close) < self.min_neighbors:
+            self._stats['too_few_neighbors'] += 1
+            return None
+        labels = {tuple(neighbor[axis] for axis in AXES) for neighbor in close}
+        if len(labels) != 1:
+            self._stats['disagreements'] += 1
+            return None
+        self._stats['propagated'] += 1
+        result = dict(zip(AXES, labels.pop()))
+        result['label_source'] = LABEL_SOURCE
+        return result
+
+    async def propagate(self, embeddings: list) -> list[dict | None]:
+        """埋め込みの順に、伝播できたカテゴリ（できなければ None）を返す"""
+        results = [None] * len(embeddings)
+        valid_indices = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        if not valid_indices:
+            return results
+        neighbors = await async_database.get_label_neighbors([embeddings[i] for i in valid_indices], self.k)
+        self._stats['lookups'] += len(valid_indices)
+        for i, post_neighbors in zip(valid_indices, neighbors):
+            results[i] = self.vote(post_neighbors)
+        return results
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats.update({
+            'enabled': self.enabled,
+            'k': self.k,
+            'min_similarity': self.min_similarity,
+            'min_neighbors': self.min_neighbors,
+            'propagation_rate': stats['propagated'] / stats['lookups'] if stats['lookups'] else 0.0,
+        })
+        return stats
+
+propagator = LabelPropagator()
@@ -1,12 +1,30 @@
 # llm_analyzer.py
 import os
+import asyncio
+import difflib
+import functools
 import json
-import re
+import random
+import threading
 import time
-import google.generativeai as genai
+from concurrent.futures import ThreadPoolExecutor
 from google.api_core import exceptions
+from google.generativeai import protos
 from dotenv import load_dotenv
 
+try:
+    import batch_planner
+    import embedding_cache
+    import embedding_provider
+    import key_scheduler
+    import text_preprocess
+except ImportError:
+    from app import batch_planner
+    from app import embedding_cache
+    from app import embedding_provider
+    from app import key_scheduler
+    from app import text_preprocess
+
 load_dotenv(encoding='utf-8')
 
 # --- APIキー管理ロジック (完全版) ---
@@ -41,52 +59,10 @@ def load_api_keys():
 
 # グローバル変数の定義
 API_KEYS = load_api_keys()
-current_key_index = 0   # 【重要】ここで初期化が必要です
-model = None
-
-def configure_genai():
-    """現在のインデックスのキーでGenAIを構成し、モデルを初期化する"""
-    global model, current_key_index
-    
-    if not API_KEYS:
-        print("【エラー】APIキーが見つかりません。.envを確認してください。")
-        return
-
-    # インデックス調整
-    if len(API_KEYS) > 0:
-        current_key_index = current_key_index % len(API_KEYS)
-        current_key = API_KEYS[current_key_index]
-    else:
-        print("【エラー】有効なAPIキーがロードされていません。")
-        return
-    
-    # デバッグ用ログ (キーの先頭と末尾のみ表示)
-    masked_key = f"{current_key[:4]}...{current_key[-4:]}" if len(current_key) > 8 else "***"
-    print(f"GenAI Configured with Key [{current_key_index + 1}/{len(API_KEYS)}]: {masked_key}")
 
-    try:
-        genai.configure(api_key=current_key)
-        # モデル初期化 (1.5-flash推奨)
-        model = genai.GenerativeModel('gemini-2.5-flash') 
-    except Exception as e:
-        print(f"API構成エラー: {e}")
-
-def rotate_api_key():
-    """次のAPIキーに切り替える"""
-    global current_key_index
-    if len(API_KEYS) <= 1:
-        print("切り替え可能な予備のAPIキーがありません。")
-        return False
-    
-    print(f"APIキーを切り替えます... (現在のIndex: {current_key_index})")
-    current_key_index += 1
-    configure_genai()
-    return True
-
-# 初回構成実行
-if API_KEYS:
-    configure_genai()
-else:
+# キーごとのクライアント・レート制限・クールダウンは key_scheduler が管理する（スレッド間で共有しても安全）
+key_pool = key_scheduler.KeyScheduler(API_KEYS)
+if not API_KEYS:
     print("【警告】有効なAPIキーがロードされませんでした。")
 
 # --- カテゴリ定義 (省略 - 変更なし) ---
@@ -262,65 +238,103 @@ STYLE_STANCE_CATEGORIES = [
 
 flat_content_categories = [item for sublist in CONTENT_CATEGORIES.values() for item in sublist]
 
-def analyze_posts_batch(texts: list[str]):
-    error_result = {
-        "content_category": "分析失敗", "expression_category": "分析失敗",
-        "style_stance_category": "分析失敗", "embedding": None
-    }
-    if not API_KEYS:
-        print("エラー: 有効なGEMINI APIキーが設定されていません。")
-        return [error_result] * len(texts)
+EMBEDDING_MODEL = embedding_provider.GEMINI_MODEL
+ERROR_RESULT = {
+    "content_category": "分析失敗", "expression_category": "分析失敗",
+    "style_stance_category": "分析失敗", "embedding": None
+}
 
-    if not texts:
-        return []
+# --- 有効なカテゴリ ---
+# 軸ごとの有効なカテゴリ（重複を除いた一覧）。リストに無いラベルは最も近い有効なカテゴリに置き換える。
+VALID_CATEGORIES = {
+    "content_category": tuple(dict.fromkeys(flat_content_categories)),
+    "expression_category": tuple(EXPRESSION_CATEGORIES),
+    "style_stance_category": tuple(STYLE_STANCE_CATEGORIES),
+}
+_VALID_CATEGORY_SETS = {axis: frozenset(categories) for axis, categories in VALID_CATEGORIES.items()}
+# ラベルが欠けている場合の値（従来どおり）
+DEFAULT_CATEGORIES = {
+    "content_category": "その他",
+    "expression_category": "その他・分類不能",
+    "style_stance_category": "その他",
+}
 
-    # 1. 埋め込みベクトルの取得
-    embeddings = [None] * len(texts)
-    valid_indices = [i for i, t in enumerate(texts) if t and t.strip()]
-    valid_texts = [texts[i] for i in valid_indices]
-
-    if valid_texts:
-        # キー数に応じてリトライ回数を決定（最低3回）
-        max_retries_embed = max(3, len(API_KEYS) * 2)
-        
-        for attempt in range(max_retries_embed):
-            try:
-                result = genai.embed_content(
-                    model="models/text-embedding-004",
-                    content=valid_texts,
-                    task_type="retrieval_document"
-                )
-                
-                if 'embedding' in result:
-                    for idx, embedding_vec in zip(valid_indices, result['embedding']):
-                        embeddings[idx] = embedding_vec
-                    break # 成功
-                else:
-                    print("埋め込み取得エラー: 結果に embedding キーがありません")
-                    break
-            
-            except exceptions.ResourceExhausted:
-                print(f"Embedding 429 Error. Key switch attempt {attempt+1}/{max_retries_embed}")
-                if rotate_api_key():
-                    time.sleep(1)
-                    continue
-                else:
-                    print("APIキーを使い切りました (Embedding)")
-                    break
-            except Exception as e:
-                # 400エラー等、キー自体が無効な場合もここでキャッチして切り替えを試みる
-                print(f"Embedding API Error: {e}")
-                if "API_KEY_INVALID" in str(e) or "400" in str(e):
-                     print("無効なAPIキーを検出しました。次のキーに切り替えます。")
-                     if rotate_api_key():
-                         time.sleep(1)
-                         continue
-                break
+# --- カテゴリのコード表 ---
+# 各軸のカテゴリに VALID_CATEGORIES 内の位置を番号として振り、プロンプトにはその対応表を、
+# 応答には投稿ごとの [内容, 表現, スタンス] の番号だけを出させる（カテゴリ名を毎回書き出させない）。
+# 番号はリストの並び順で決まるので、カテゴリを追加するときは各リストの末尾に足すこと。
+# 出力の形式と読み取り方が変わるため既定では使わない。LLM_CATEGORY_CODEBOOK=1 で有効にし、
+# analysis/run_experiment.py → run_accuracy_analysis.py でカテゴリ名の形式と正解率を比べてから切り替えること。
+CATEGORY_CODEBOOK = os.getenv('LLM_CATEGORY_CODEBOOK', '0') == '1'
+CATEGORY_AXES = tuple(VALID_CATEGORIES)
+AXIS_LABELS = {
+    "content_category": "内容",
+    "expression_category": "表現",
+    "style_stance_category": "スタンス",
+}
+
+def _build_codebook_prompt() -> str:
+    sections = []
+    for axis in CATEGORY_AXES:
+        codes = "\n".join(f"{code}:{category}" for code, category in enumerate(VALID_CATEGORIES[axis]))
+        sections.append(f"## {AXIS_LABELS[axis]}\n{codes}")
+    codebook = "\n\n".join(sections)
+    return f"""以下のSNS投稿を分析し、内容・表現・スタンスの3つの軸で最も適切なカテゴリを1つずつ、コード表の番号で選択してください。
+
+# コード表 (番号:カテゴリ)
+{codebook}
+
+# 出力形式
+投稿の順番通りに [内容の番号, 表現の番号, スタンスの番号] を並べたJSONリストのみを出力してください。
+例: [[12, 0, 6], [301, 17, 9]]
+
+"""
+
+# 起動時に1回だけ組み立てる（リクエストごとには投稿部分を連結するだけ）
+CODEBOOK_PROMPT = _build_codebook_prompt()
+
+# 埋め込みと分類は別々のステージとして、バッチの大きさ・同時実行数・再試行回数をそれぞれ設定する
+# 1ワーカーで同時に投げる分類呼び出しの上限（非同期版）
+ASYNC_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+_async_semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+# 埋め込みAPIは1リクエスト100件まで受け付ける（分類プロンプトよりずっと大きなバッチにできる）
+EMBED_BATCH_SIZE = int(os.getenv('LLM_EMBED_BATCH_SIZE', '100'))
+EMBED_MAX_CONCURRENCY = int(os.getenv('LLM_EMBED_MAX_CONCURRENCY', '4'))
+_embed_semaphore = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+
+# 429 を受けた後の再試行の待ち時間（指数バックオフ + フルジッター）。
+# キーのクールダウンとは別に待つので、キーが1つだけ・全キーがクールダウン中でも再試行の間隔が伸びていく
+RETRY_BASE_SECONDS = float(os.getenv('LLM_RETRY_BASE_SECONDS', '1.0'))
+RETRY_MAX_SECONDS = float(os.getenv('LLM_RETRY_MAX_SECONDS', '30.0'))
+
+def backoff_with_jitter(attempt: int) -> float:
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+def _max_retries(env_name: str) -> int:
+    """再試行回数（未指定ならキー数に応じて決める。最低3回）"""
+    return int(os.getenv(env_name, '0')) or max(3, len(API_KEYS) * 2)
+
+# キーごとの TPM 管理に使うトークン数の概算（日本語はおおむね1〜2文字で1トークン）
+CHARS_PER_TOKEN = text_preprocess.CHARS_PER_TOKEN
+OUTPUT_TOKENS_PER_POST = 12 if CATEGORY_CODEBOOK else 40
+
+estimate_tokens = text_preprocess.estimate_tokens
+
+def prompt_tokens(text: str) -> int:
+    """分類プロンプトに貼るとき（前処理後）の推定トークン数。バッチの大きさを決めるのに使う"""
+    return estimate_tokens(text_preprocess.preprocess(text))
+
+def _build_codebook_request(texts: list[str]) -> str:
+    posts = "\n".join(f"投稿{i+1}:\n---\n{text}\n---" for i, text in enumerate(texts))
+    return f"{CODEBOOK_PROMPT}# 投稿リスト（{len(texts)}件。出力も必ず{len(texts)}個）\n{posts}\n"
+
+def build_prompt(texts: list[str]) -> str:
+    if CATEGORY_CODEBOOK:
+        return _build_codebook_request(texts)
 
-    # 2. 分類タスク
     formatted_texts = "\\n".join(f"投稿{i+1}:\\n---\\n{text}\\n---" for i, text in enumerate(texts))
 
-    prompt = f"""
+    return f"""
 以下のSNS投稿リスト（{len(texts)}件）を分析し、3つの軸で最も適切なカテゴリを1つずつ選択してください。
 回答は、JSONオブジェクトのリスト形式で、投稿の順番通りに出力してください。
 
@@ -343,57 +357,465 @@ def analyze_posts_batch(texts: list[str]):
   ...
 ]
 """
-    
-    max_retries = max(3, len(API_KEYS) * 2)
-    base_delay = 5
+
+# 構造化出力: enum を指定したスキーマで、有効なカテゴリ以外を出力できないようにする（スキーマは起動時に1回だけ組み立てる）
+STRUCTURED_OUTPUT = os.getenv('LLM_STRUCTURED_OUTPUT', '1') == '1'
+
+def _response_schema() -> protos.Schema:
+    if CATEGORY_CODEBOOK:
+        # 番号の範囲は enum で指定できないため、デコード時に検証する
+        return protos.Schema(
+            type_=protos.Type.ARRAY,
+            items=protos.Schema(
+                type_=protos.Type.ARRAY,
+                items=protos.Schema(type_=protos.Type.INTEGER),
+                min_items=len(CATEGORY_AXES), max_items=len(CATEGORY_AXES),
+            ),
+        )
+    return protos.Schema(
+        type_=protos.Type.ARRAY,
+        items=protos.Schema(
+            type_=protos.Type.OBJECT,
+            properties={
+                axis: protos.Schema(type_=protos.Type.STRING, format_="enum", enum=list(categories))
+                for axis, categories in VALID_CATEGORIES.items()
+            },
+            required=list(VALID_CATEGORIES),
+        ),
+    )
+
+GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": _response_schema(),
+} if STRUCTURED_OUTPUT else None
+
+# 表記揺れ（全角・半角、一部の欠け等）とみなして有効なカテゴリに対応付ける類似度の下限。
+# これより遠いラベルはスキーマ違反として扱い、その投稿以降は再送する（1件でも駄目なら「分類不能」）
+LABEL_MATCH_CUTOFF = float(os.getenv('LLM_LABEL_MATCH_CUTOFF', '0.8'))
+
+@functools.lru_cache(maxsize=4096)
+def nearest_category(axis: str, label: str) -> str | None:
+    """リストに無いラベルを、文字列として十分に近い有効なカテゴリに対応付ける（無ければ None）"""
+    matches = difflib.get_close_matches(label, VALID_CATEGORIES[axis], n=1, cutoff=LABEL_MATCH_CUTOFF)
+    return matches[0] if matches else None
+
+def _validate(axis: str, label) -> str | None:
+    """有効なカテゴリ名を返す。欠けていれば既定値、対応付けられないラベルなら None"""
+    if label in _VALID_CATEGORY_SETS[axis]:
+        return label
+    if label is None or label == '':
+        return DEFAULT_CATEGORIES[axis]
+    category = nearest_category(axis, label) if isinstance(label, str) else None
+    _count('remapped_labels' if category is not None else 'rejected_labels')
+    return category
+
+def _decode(axis: str, code) -> str | None:
+    """コード表の番号をカテゴリ名に戻す（番号でなく名前が返ってきた場合はそのまま検証する）"""
+    categories = VALID_CATEGORIES[axis]
+    if isinstance(code, int) and 0 <= code < len(categories):
+        return categories[code]
+    if code is None or isinstance(code, str):
+        return _validate(axis, code)
+    _count('rejected_labels')
+    return None
+
+def _categories_of(result) -> dict | None:
+    """1件分の応答を3軸のカテゴリにする。いずれかの軸が対応付けられなければ None"""
+    if isinstance(result, list):
+        codes = result + [None] * (len(CATEGORY_AXES) - len(result))
+        categories = {axis: _decode(axis, code) for axis, code in zip(CATEGORY_AXES, codes)}
+    else:
+        categories = {axis: _validate(axis, result.get(axis)) for axis in VALID_CATEGORIES}
+    return categories if None not in categories.values() else None
+
+def _valid_prefix(categories: list) -> list[dict]:
+    """対応付けられなかった投稿より前だけを返す（それ以降は件数不一致と同じく再送される）"""
+    if None not in categories:
+        return categories
+    valid = categories[:categories.index(None)]
+    print(f"エラー: 有効なカテゴリに対応付けられないラベルがありました (読み取れた件数: {len(valid)}/{len(categories)})")
+    return valid
+
+_json_decoder = json.JSONDecoder()
+
+def parse_response(response_text: str) -> list[dict]:
+    """
+    LLMの応答から投稿ごとのカテゴリを先頭から順に取り出す。
+    各要素はカテゴリ名のオブジェクト、またはコード表モードでは番号のリスト。
+    構造化出力なら応答全体がそのままJSONなので1回で読み込む。
+    出力が途中で打ち切られていても、閉じているオブジェクトまでは読み取る（件数の確認は呼び出し側で行う）。
+    """
+    try:
+        results = json.loads(response_text)
+        if isinstance(results, list) and all(isinstance(result, (dict, list)) for result in results):
+            return _valid_prefix([_categories_of(result) for result in results])
+    except json.JSONDecodeError:
+        pass
+
+    pos = response_text.find('[')
+    if pos < 0:
+        print("エラー: LLM応答からJSONリストが見つかりません。")
+        return []
+    categories = []
+    pos += 1
+    while True:
+        while pos < len(response_text) and response_text[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(response_text) or response_text[pos] == ']':
+            break
+        try:
+            result, pos = _json_decoder.raw_decode(response_text, pos)
+        except json.JSONDecodeError:
+            break
+        if not isinstance(result, (dict, list)):
+            break
+        categories.append(_categories_of(result))
+    return _valid_prefix(categories)
+
+def _valid_texts(texts: list[str]):
+    valid_indices = [i for i, t in enumerate(texts) if t and t.strip()]
+    return valid_indices, [texts[i] for i in valid_indices]
+
+def _set_embeddings(embeddings: list, valid_indices: list[int], result) -> None:
+    if 'embedding' in result:
+        for idx, embedding_vec in zip(valid_indices, result['embedding']):
+            embeddings[idx] = embedding_vec
+    else:
+        print("埋め込み取得エラー: 結果に embedding キーがありません")
+
+def _embed(texts: list[str]) -> list:
+    embeddings = [None] * len(texts)
+    valid_indices, valid_texts = _valid_texts(texts)
+    if not valid_texts:
+        return embeddings
+
+    tokens = sum(estimate_tokens(t) for t in valid_texts)
+    max_retries_embed = _max_retries('LLM_EMBED_MAX_RETRIES')
+    for attempt in range(max_retries_embed):
+        try:
+            with key_pool.lease('embed', tokens) as api_key:
+                result = api_key.embed_content(
+                    model=EMBEDDING_MODEL,
+                    content=valid_texts,
+                    task_type="retrieval_document"
+                )
+            _set_embeddings(embeddings, valid_indices, result)
+            break
+        except exceptions.ResourceExhausted:
+            # 429を受けたキーはクールダウンに入るので、次の試行では別のキー（または空いたキー）が割り当てられる
+            print(f"Embedding 429 Error. Retrying with another key... (Attempt {attempt+1}/{max_retries_embed})")
+        except key_scheduler.NoAvailableKey as e:
+            print(f"APIキーを使い切りました (Embedding): {e}")
+            break
+        except Exception as e:
+            # 400エラー等、キー自体が無効な場合は別のキーで再試行する
+            print(f"Embedding API Error: {e}")
+            if not key_scheduler.is_invalid_key_error(e):
+                break
+    return embeddings
+
+def _generation_tokens(prompt: str, n_posts: int) -> int:
+    return estimate_tokens(prompt) + OUTPUT_TOKENS_PER_POST * n_posts
+
+BLOCKED_FINISH_REASONS = {'SAFETY', 'PROHIBITED_CONTENT', 'BLOCKLIST', 'SPII', 'RECITATION'}
+
+def _finish_reason(response) -> str | None:
+    try:
+        return response.candidates[0].finish_reason.name
+    except (AttributeError, IndexError):
+        return None
+
+def _is_blocked(response) -> bool:
+    """プロンプト全体、または出力が安全フィルター等でブロックされたか"""
+    feedback = getattr(response, 'prompt_feedback', None)
+    if feedback is not None and getattr(feedback, 'block_reason', 0):
+        return True
+    return _finish_reason(response) in BLOCKED_FINISH_REASONS
+
+def _read_response(response, n_posts: int, latency: float) -> list[dict]:
+    """
+    応答から読み取れたカテゴリを返し（件数が足りない・多い場合もそのまま返す）、
+    結果（成功・出力の打ち切り・件数不一致・ブロック）をバッチプランナーに伝える。
+    """
+    if _is_blocked(response):
+        print(f"エラー: 応答がブロックされました ({n_posts}件)")
+        categories, outcome = [], 'blocked'
+    else:
+        try:
+            categories = parse_response(response.text)
+        except Exception as e:
+            print(f"LLM応答の解析エラー: {e}")
+            categories = []
+        if len(categories) == n_posts:
+            outcome = 'ok'
+        elif _finish_reason(response) == 'MAX_TOKENS':
+            print(f"エラー: 出力が上限で打ち切られました (期待: {n_posts}, 読み取れた件数: {len(categories)})")
+            outcome = 'truncated'
+        else:
+            print(f"エラー: 結果件数不一致 (期待: {n_posts}, 実際: {len(categories)})")
+            outcome = 'mismatch'
+    batch_planner.planner.observe(n_posts, latency, outcome)
+    return categories
+
+# --- 部分的な失敗からの回復 ---
+# 件数が合わない・ブロックされたバッチは、読み取れた先頭部分を採用し、残りだけを再送する。
+# 何も読み取れなければ半分に分けて再送する。1件まで絞っても分類できない投稿は一時的な失敗の可能性があるので
+# LLM_SINGLE_POST_RETRIES 回まで送り直し、それでも駄目なら「分類不能」として確定させる。
+# 確定した結果は label_source = 'unclassifiable' で保存し、ローカル分類器の学習・ラベル伝播には使わない。
+UNCLASSIFIABLE = "分類不能"
+UNCLASSIFIABLE_SOURCE = 'unclassifiable'
+UNCLASSIFIABLE_RESULT = {
+    "content_category": UNCLASSIFIABLE, "expression_category": UNCLASSIFIABLE,
+    "style_stance_category": UNCLASSIFIABLE, "label_source": UNCLASSIFIABLE_SOURCE,
+}
+SINGLE_POST_RETRIES = int(os.getenv('LLM_SINGLE_POST_RETRIES', '1'))
+_recovery_lock = threading.Lock()
+_recovery_stats = {'partial_batches': 0, 'salvaged_posts': 0, 'bisections': 0, 'single_post_retries': 0,
+                   'unclassifiable_posts': 0, 'remapped_labels': 0, 'rejected_labels': 0}
+
+def _count(name: str, n: int = 1):
+    with _recovery_lock:
+        _recovery_stats[name] += n
+
+def get_recovery_stats() -> dict:
+    with _recovery_lock:
+        return dict(_recovery_stats)
+
+def _salvage(n_posts: int, categories: list[dict]) -> list[dict]:
+    """件数が合わない応答のうち、信頼できる先頭部分（多すぎる場合は投稿との対応が取れないので空）"""
+    _count('partial_batches')
+    prefix = categories if len(categories) < n_posts else []
+    _count('salvaged_posts', len(prefix))
+    return prefix
+
+def _give_up(text: str) -> list[dict]:
+    _count('unclassifiable_posts')
+    print(f"⚠️ 1件単位でも分類できなかった投稿を「{UNCLASSIFIABLE}」とします: {text[:30]!r}")
+    return [UNCLASSIFIABLE_RESULT]
+
+def _plan(texts: list[str]) -> list[range]:
+    return batch_planner.planner.plan([estimate_tokens(text) for text in texts])
+
+def _embed_chunks(texts: list[str]) -> list[range]:
+    return [range(start, min(start + EMBED_BATCH_SIZE, len(texts))) for start in range(0, len(texts), EMBED_BATCH_SIZE)]
+
+def merge_result(categories: dict | None, embedding) -> dict:
+    """1件分の分類結果と埋め込みを分析結果にまとめる（分類に失敗した投稿は ERROR_RESULT）"""
+    return {**categories, "embedding": embedding} if categories is not None else ERROR_RESULT
+
+def merge_results(categories: list, embeddings: list) -> list[dict]:
+    return [merge_result(category, embedding) for category, embedding in zip(categories, embeddings)]
+
+def _request_categories(texts: list[str]) -> list[dict] | None:
+    """1回の分類呼び出し。APIエラーで応答が得られなかった場合は None（後で再リクエストされる）"""
+    prompt = build_prompt(texts)
+    tokens = _generation_tokens(prompt, len(texts))
+    max_retries = _max_retries('LLM_GENERATE_MAX_RETRIES')
 
     for attempt in range(max_retries):
         try:
-            response = model.generate_content(prompt)
-            match = re.search(r'```json\s*(\[.*\])\s*```|(\[.*\])', response.text, re.DOTALL)
-            if not match:
-                print("エラー: LLM応答からJSONリストが見つかりません。")
-                return [error_result] * len(texts)
-
-            json_text = match.group(1) or match.group(2)
-            analysis_results_json = json.loads(json_text)
-
-            if isinstance(analysis_results_json, list) and len(analysis_results_json) == len(texts):
-                full_results = []
-                for i, result in enumerate(analysis_results_json):
-                    final_result = {
-                        "content_category": result.get("content_category", "その他"),
-                        "expression_category": result.get("expression_category", "その他・分類不能"),
-                        "style_stance_category": result.get("style_stance_category", "その他"),
-                        "embedding": embeddings[i]
-                    }
-                    full_results.append(final_result)
-                return full_results
-            else:
-                print(f"エラー: 結果件数不一致 (期待: {len(texts)}, 実際: {len(analysis_results_json)})")
-                return [error_result] * len(texts)
-                
+            with key_pool.lease('generate', tokens) as api_key:
+                start = time.monotonic()
+                response = api_key.model.generate_content(prompt, generation_config=GENERATION_CONFIG)
+            return _read_response(response, len(texts), time.monotonic() - start)
         except exceptions.ResourceExhausted:
-            print(f"Generation 429 Error. Switching key... (Attempt {attempt+1}/{max_retries})")
-            if rotate_api_key():
-                time.sleep(1)
-                continue
-            else:
-                if attempt < max_retries - 1:
-                    sleep_time = base_delay * (2 ** attempt)
-                    print(f"No more keys. Retrying in {sleep_time} seconds...")
-                    time.sleep(sleep_time)
-                    continue
-                else:
-                    return [error_result] * len(texts)
-        
+            print(f"Generation 429 Error. Retrying with another key... (Attempt {attempt+1}/{max_retries})")
+        except key_scheduler.NoAvailableKey as e:
+            print(f"APIキーを使い切りました (Generation): {e}")
+            break
         except Exception as e:
             print(f"LLM Generate Error: {e}")
-            if "API_KEY_INVALID" in str(e) or "400" in str(e):
-                 print("無効なAPIキーを検出しました。次のキーに切り替えます。")
-                 if rotate_api_key():
-                     time.sleep(1)
-                     continue
-            return [error_result] * len(texts)
-    
-    return [error_result] * len(texts)
\ No newline at end of file
+            if not key_scheduler.is_invalid_key_error(e):
+                break
+    return None
+
+def _classify(texts: list[str], single_retries: int = SINGLE_POST_RETRIES) -> list[dict]:
+    categories = _request_categories(texts)
+    if categories is None:
+        return [None] * len(texts)
+    if len(categories) == len(texts):
+        return categories
+
+    prefix = _salvage(len(texts), categories)
+    rest = texts[len(prefix):]
+    if prefix:
+        return prefix + _classify(rest)
+    if len(rest) == 1:
+        if single_retries > 0:
+            _count('single_post_retries')
+            return _classify(rest, single_retries - 1)
+        return _give_up(rest[0])
+    _count('bisections')
+    mid = len(rest) // 2
+    return _classify(rest[:mid]) + _classify(rest[mid:])
+
+def embed_texts(texts: list[str]) -> list:
+    """埋め込みステージ: 設定されたバックエンド (embedder) で埋め込みを取得する（失敗した投稿は None）"""
+    return embedder.embed(texts)
+
+def classify_texts(texts: list[str]) -> list:
+    """分類ステージ: 本文を前処理し、batch_planner が決めた大きさのバッチごとに分類する（失敗した投稿は None）"""
+    texts = text_preprocess.preprocess_batch(texts)
+    categories = []
+    for batch in _plan(texts):
+        categories.extend(_classify(texts[batch.start:batch.stop]))
+    return categories
+
+def analyze_posts_batch(texts: list[str]):
+    """
+    投稿を分析する。埋め込みと分類は別々のバッチで並行して取得し、投稿ごとに結合する。
+    分類は渡された件数をそのまま1つのプロンプトにはせず、
+    batch_planner が推定トークン数と直近の応答状況から決めた大きさのバッチに分けて行う。
+    """
+    if not API_KEYS:
+        print("エラー: 有効なGEMINI APIキーが設定されていません。")
+        return [ERROR_RESULT] * len(texts)
+
+    if not texts:
+        return []
+
+    text_preprocess.log_summary(texts)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        embeddings_future = executor.submit(embed_texts, texts)
+        categories = classify_texts(texts)
+        embeddings = embeddings_future.result()
+
+    return merge_results(categories, embeddings)
+
+# --- 非同期版 ---
+async def _embed_async(texts: list[str]) -> list:
+    embeddings = [None] * len(texts)
+    valid_indices, valid_texts = _valid_texts(texts)
+    if not valid_texts:
+        return embeddings
+
+    tokens = sum(estimate_tokens(t) for t in valid_texts)
+    max_retries_embed = _max_retries('LLM_EMBED_MAX_RETRIES')
+    for attempt in range(max_retries_embed):
+        try:
+            # 送信できる順番が来てからキーの枠を取る（セマフォ待ちの間に枠と in_flight を押さえない）
+            async with _embed_semaphore:
+                async with key_pool.lease_async('embed', tokens) as api_key:
+                    result = await api_key.embed_content_async(
+                        model=EMBEDDING_MODEL,
+                        content=valid_texts,
+                        task_type="retrieval_document"
+                    )
+            _set_embeddings(embeddings, valid_indices, result)
+            break
+        except exceptions.ResourceExhausted:
+            print(f"Embedding 429 Error (async). Retrying with another key... (Attempt {attempt+1}/{max_retries_embed})")
+            if attempt + 1 < max_retries_embed:
+                await asyncio.sleep(backoff_with_jitter(attempt))
+        except key_scheduler.NoAvailableKey as e:
+            print(f"APIキーを使い切りました (Embedding): {e}")
+            break
+        except Exception as e:
+            print(f"Embedding API Error: {e}")
+            if not key_scheduler.is_invalid_key_error(e):
+                break
+    return embeddings
+
+async def _request_categories_async(texts: list[str]) -> list[dict] | None:
+    prompt = build_prompt(texts)
+    tokens = _generation_tokens(prompt, len(texts))
+    max_retries = _max_retries('LLM_GENERATE_MAX_RETRIES')
+
+    for attempt in range(max_retries):
+        try:
+            async with _async_semaphore:
+                async with key_pool.lease_async('generate', tokens) as api_key:
+                    start = time.monotonic()
+                    response = await api_key.async_model.generate_content_async(prompt, generation_config=GENERATION_CONFIG)
+            return _read_response(response, len(texts), time.monotonic() - start)
+        except exceptions.ResourceExhausted:
+            print(f"Generation 429 Error (async). Retrying with another key... (Attempt {attempt+1}/{max_retries})")
+            if attempt + 1 < max_retries:
+                await asyncio.sleep(backoff_with_jitter(attempt))
+        except key_scheduler.NoAvailableKey as e:
+            print(f"APIキーを使い切りました (Generation): {e}")
+            break
+        except Exception as e:
+            print(f"LLM Generate Error: {e}")
+            if not key_scheduler.is_invalid_key_error(e):
+                break
+    return None
+
+async def _classify_async(texts: list[str], single_retries: int = SINGLE_POST_RETRIES) -> list[dict]:
+    categories = await _request_categories_async(texts)
+    if categories is None:
+        return [None] * len(texts)
+    if len(categories) == len(texts):
+        return categories
+
+    prefix = _salvage(len(texts), categories)
+    rest = texts[len(prefix):]
+    if prefix:
+        return prefix + await _classify_async(rest)
+    if len(rest) == 1:
+        if single_retries > 0:
+            _count('single_post_retries')
+            return await _classify_async(rest, single_retries - 1)
+        return _give_up(rest[0])
+    _count('bisections')
+    mid = len(rest) // 2
+    left, right = await asyncio.gather(_classify_async(rest[:mid]), _classify_async(rest[mid:]))
+    return left + right
+
+async def embed_texts_async(texts: list[str]) -> list:
+    return await embedder.embed_async(texts)
+
+async def classify_texts_async(texts: list[str]) -> list:
+    """classify_texts の asyncio 版。各バッチを並行して分類する（同時実行数は LLM_MAX_CONCURRENCY）"""
+    texts = text_preprocess.preprocess_batch(texts)
+    batches = await asyncio.gather(*(_classify_async(texts[batch.start:batch.stop]) for batch in _plan(texts)))
+    return [category for batch_categories in batches for category in batch_categories]
+
+async def analyze_posts_batch_async(texts: list[str]):
+    """
+    analyze_posts_batch の asyncio 版。空きキーや再試行の待ちは asyncio.sleep なのでスレッドを占有しない
+    （キーの空き待ちの間はセマフォを手放す）。
+    """
+    if not API_KEYS:
+        print("エラー: 有効なGEMINI APIキーが設定されていません。")
+        return [ERROR_RESULT] * len(texts)
+
+    if not texts:
+        return []
+
+    text_preprocess.log_summary(texts)
+    # 埋め込みと分類は互いに依存しないので並行して投げる
+    embeddings, categories = await asyncio.gather(embed_texts_async(texts), classify_texts_async(texts))
+    return merge_results(categories, embeddings)
+
+# --- 埋め込みバックエンド ---
+class GeminiEmbeddingProvider(embedding_provider.EmbeddingProvider):
+    """text-embedding-004。EMBED_BATCH_SIZE 件ずつ、APIキーの埋め込み用の枠を使って取得する"""
+
+    name = 'gemini'
+    model_id = EMBEDDING_MODEL
+    dimension = embedding_provider.GEMINI_DIMENSION
+    batch_size = EMBED_BATCH_SIZE
+
+    def embed(self, texts: list[str]) -> list:
+        embeddings = []
+        for chunk in _embed_chunks(texts):
+            embeddings.extend(_embed(texts[chunk.start:chunk.stop]))
+        return embeddings
+
+    async def embed_async(self, texts: list[str]) -> list:
+        """各チャンクを並行して取得する（同時実行数は LLM_EMBED_MAX_CONCURRENCY）"""
+        chunks = await asyncio.gather(*(_embed_async(texts[chunk.start:chunk.stop]) for chunk in _embed_chunks(texts)))
+        return [embedding for chunk in chunks for embedding in chunk]
+
+def _create_embedder() -> embedding_provider.EmbeddingProvider:
+    if embedding_provider.PROVIDER == 'local':
+        embedder = embedding_provider.LocalEmbeddingProvider()
+    else:
+        if embedding_provider.PROVIDER != 'gemini':
+            print(f"【警告】不明な EMBEDDING_PROVIDER ({embedding_provider.PROVIDER}) のため gemini を使います。")
+        embedder = GeminiEmbeddingProvider()
+    # 同じ本文・同じモデルの埋め込みは DB のキャッシュから返す
+    return embedding_cache.CachedEmbeddingProvider(embedder) if embedding_cache.ENABLED else embedder
+
+embedder = _create_embedder()
@@ -0,0 +1,221 @@
+# local_classifier.py
+# post_analysis_cache に溜まった「埋め込み + LLMが付けた3軸のカテゴリ」を教師データにして、
+# 軸ごとの多クラスロジスティック回帰（softmax回帰）を学習する。
+# 3軸とも確信度が閾値以上の投稿はこの分類器の予測をそのまま使い、残りだけをLLMに送る。
+#   - 学習は定期的にやり直す（LOCAL_CLASSIFIER_RETRAIN_SECONDS）。LLMが付けたラベルだけを使い、自分の予測では学習しない
+#   - 学習データの一部を検証用に取り分け、閾値での正解率が LOCAL_CLASSIFIER_MIN_ACCURACY 未満なら予測を使わない
+# 研究用の分類結果が変わるため既定では無効。LOCAL_CLASSIFIER_ENABLED=1 で有効にする
+# （有効にすると分析は「埋め込み → 分類器 → 残りだけLLM」の順になり、/api/metrics の local_classifier で検証結果を確認できる）。
+
+import asyncio
+import os
+import threading
+import time
+
+import numpy as np
+
+try:
+    import database
+except ImportError:
+    from app import database
+
+ENABLED = os.getenv('LOCAL_CLASSIFIER_ENABLED', '0') == '1'
+THRESHOLD = float(os.getenv('LOCAL_CLASSIFIER_THRESHOLD', '0.9'))              # 各軸の予測確率がこれ以上なら採用する
+MIN_ACCURACY = float(os.getenv('LOCAL_CLASSIFIER_MIN_ACCURACY', '0.85'))       # 検証データでの（3軸とも）正解率の下限
+RETRAIN_SECONDS = float(os.getenv('LOCAL_CLASSIFIER_RETRAIN_SECONDS', '3600'))
+MIN_TRAINING_ROWS = int(os.getenv('LOCAL_CLASSIFIER_MIN_ROWS', '2000'))
+MAX_TRAINING_ROWS = int(os.getenv('LOCAL_CLASSIFIER_MAX_ROWS', '50000'))      # 新しい順にこの件数まで使う
+MIN_CLASS_EXAMPLES = int(os.getenv('LOCAL_CLASSIFIER_MIN_CLASS_EXAMPLES', '10'))
+
+EPOCHS = 20
+BATCH_SIZE = 512
+LEARNING_RATE = 0.01
+L2 = 1e-4
+VALIDATION_FRACTION = 0.1
+
+AXES = ("content_category", "expression_category", "style_stance_category")
+LABEL_SOURCE = 'local_classifier'
+
+class _SoftmaxHead:
+    """1つの軸の分類器。例の少ないカテゴリは最後の「その他」クラスにまとめ、そこに分類されたら予測しない"""
+
+    def __init__(self, labels: list[str], weights: np.ndarray, bias: np.ndarray):
+        self.labels = labels
+        self.weights = weights
+        self.bias = bias
+
+    def predict(self, matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """(予測クラスの番号, その確率) を返す。番号が len(labels) なら「その他」"""
+        logits = matrix @ self.weights + self.bias
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        classes = probs.argmax(axis=1)
+        return classes, probs[np.arange(len(classes)), classes]
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _fit_head(matrix: np.ndarray, labels: list[str], rng: np.random.Generator) -> _SoftmaxHead:
+    """ミニバッチの Adam で softmax 回帰を学習する"""
+    values, counts = np.unique(np.asarray(labels, dtype=object), return_counts=True)
+    kept = [value for value, count in zip(values, counts) if count >= MIN_CLASS_EXAMPLES]
+    index = {label: i for i, label in enumerate(kept)}
+    other = len(kept)
+    y = np.array([index.get(label, other) for label in labels], dtype=np.intp)
+
+    n, dim = matrix.shape
+    n_classes = other + 1
+    weights = np.zeros((dim, n_classes), dtype=np.float32)
+    bias = np.zeros(n_classes, dtype=np.float32)
+    moments = [np.zeros_like(weights), np.zeros_like(bias), np.zeros_like(weights), np.zeros_like(bias)]
+    beta1, beta2, eps, step = 0.9, 0.999, 1e-8, 0
+    for _ in range(EPOCHS):
+        order = rng.permutation(n)
+        for start in range(0, n, BATCH_SIZE):
+            batch = order[start:start + BATCH_SIZE]
+            x = matrix[batch]
+            logits = x @ weights + bias
+            logits -= logits.max(axis=1, keepdims=True)
+            probs = np.exp(logits)
+            probs /= probs.sum(axis=1, keepdims=True)
+            probs[np.arange(len(batch)), y[batch]] -= 1.0
+            probs /= len(batch)
+            grads = (x.T @ probs + L2 * weights, probs.sum(axis=0))
+            step += 1
+            for param, grad, m, v in ((weights, grads[0], moments[0], moments[2]), (bias, grads[1], moments[1], moments[3])):
+                m *= beta1
+                m += (1 - beta1) * grad
+                v *= beta2
+                v += (1 - beta2) * grad * grad
+                m_hat = m / (1 - beta1 ** step)
+                v_hat = v / (1 - beta2 ** step)
+                param -= LEARNING_RATE * m_hat / (np.sqrt(v_hat) + eps)
+    return _SoftmaxHead(kept, weights, bias)
+
+class LocalClassifier:
+    def __init__(self, threshold: float = THRESHOLD, min_accuracy: float = MIN_ACCURACY, enabled: bool = ENABLED):
+        self.threshold = threshold
+        self.min_accuracy = min_accuracy
+        self.enabled = enabled
+        self._heads = None           # 軸 → _SoftmaxHead（学習前は None）
+        self._model_id = None        # 学習に使った埋め込みのモデル
+        self._train_lock = threading.Lock()
+        self._task = None
+        self._validation = {}
+        self._stats = {'trainings': 0, 'training_rows': 0, 'trained_at': None, 'training_seconds': 0.0,
+                       'predicted': 0, 'confident': 0}
+
+    @property
+    def ready(self) -> bool:
+        """学習済みで、検証データでの正解率が下限以上のときだけ予測を使う"""
+        return (self.enabled and self._heads is not None and self._model_id == database.EMBEDDING_MODEL_ID
+                and self._validation.get('accuracy', 0.0) >= self.min_accuracy)
+
+    # --- 学習 ---
+    def train(self, rows: list[dict], matrix: np.ndarray) -> bool:
+        """学習データ（各軸のラベルを持つ行と、同じ順の埋め込み行列）から全軸を学習し直す"""
+        if len(rows) < MIN_TRAINING_ROWS:
+            print(f"ℹ️ ローカル分類器: 学習データが不足しています ({len(rows)}/{MIN_TRAINING_ROWS}件)")
+            return False
+        start = time.monotonic()
+        rng = np.random.default_rng(0)
+        matrix = _normalize(np.asarray(matrix, dtype=np.float32))
+        order = rng.permutation(len(rows))
+        n_validation = max(1, int(len(rows) * VALIDATION_FRACTION))
+        validation, training = order[:n_validation], order[n_validation:]
+
+        heads = {
+            axis: _fit_head(matrix[training], [rows[i][axis] for i in training], rng)
+            for axis in AXES
+        }
+        validation_stats = self._evaluate(heads, matrix[validation], [rows[i] for i in validation])
+        with self._train_lock:
+            self._heads = heads
+            self._model_id = database.EMBEDDING_MODEL_ID
+            self._validation = validation_stats
+            self._stats['trainings'] += 1
+            self._stats['training_rows'] = len(training)
+            self._stats['trained_at'] = time.time()
+            self._stats['training_seconds'] = time.monotonic() - start
+        print(f"🎓 ローカル分類器を学習しました ({len(training)}件, {self._stats['training_seconds']:.1f}秒): "
+              f"閾値 {self.threshold} で検証データの {validation_stats['coverage']:.0%} を予測、正解率 {validation_stats['accuracy']:.1%}")
+        return True
+
+    def _confident(self, heads: dict, matrix: np.ndarray) -> tuple[np.ndarray, dict]:
+        """3軸とも閾値以上の確信度で「その他」以外に分類された行のマスクと、軸ごとの予測ラベルを返す"""
+        mask = np.ones(len(matrix), dtype=bool)
+        predictions = {}
+        for axis, head in heads.items():
+            classes, probs = head.predict(matrix)
+            mask &= (classes < len(head.labels)) & (probs >= self.threshold)
+            predictions[axis] = [head.labels[c] if c < len(head.labels) else None for c in classes]
+        return mask, predictions
+
+    def _evaluate(self, heads: dict, matrix: np.ndarray, rows: list[dict]) -> dict:
+        mask, predictions = self._confident(heads, matrix)
+        covered = np.flatnonzero(mask)
+        correct = sum(all(predictions[axis][i] == rows[i][axis] for axis in AXES) for i in covered)
+        return {
+            'rows': len(rows),
+            'coverage': len(covered) / len(rows) if rows else 0.0,
+            'accuracy': correct / len(covered) if len(covered) else 0.0,
+        }
+
+    def retrain(self) -> bool:
+        rows, matrix = database.get_classifier_training_rows(MAX_TRAINING_ROWS)
+        return self.train(rows, matrix)
+
+    # --- 予測 ---
+    def predict(self, embedding) -> dict | None:
+        """確信度が閾値以上なら3軸のカテゴリを返し、そうでなければ None（LLMで分類する）"""
+        if embedding is None or not self.ready:
+            return None
+        heads = self._heads
+        matrix = _normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))
+        mask, predictions = self._confident(heads, matrix)
+        self._stats['predicted'] += 1
+        if not mask[0]:
+            return None
+        self._stats['confident'] += 1
+        result = {axis: predictions[axis][0] for axis in AXES}
+        result['label_source'] = LABEL_SOURCE
+        return result
+
+    # --- 定期的な再学習 ---
+    def start(self):
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.retrain)
+            except Exception as e:
+                print(f"⚠️ ローカル分類器の学習に失敗しました: {e}")
+            await asyncio.sleep(RETRAIN_SECONDS)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats.update({
+            'enabled': self.enabled,
+            'ready': self.ready,
+            'threshold': self.threshold,
+            'min_accuracy': self.min_accuracy,
+            'validation': dict(self._validation),
+            'confident_rate': stats['confident'] / stats['predicted'] if stats['predicted'] else 0.0,
+        })
+        return stats
+
+classifier = LocalClassifier()
@@ -14,16 +14,39 @@ import numpy as np
 
 # 自作モジュールのインポート
 import database
+import async_database
+import filter_context
 import quiz_checker
 import timeline_checker
 import personality_descriptions
 import llm_analyzer
 import type_descriptions
+import similarity
+import filter_rules
+import text_hash
+import analysis_coalescer
+import batch_planner
+import local_classifier
+import label_propagation
+import text_preprocess
 
 app = FastAPI()
 @app.on_event("startup")
-def on_startup():
-    database.initialize_database()
+async def on_startup():
+    await run_in_threadpool(database.initialize_database)
+    await async_database.open_pool()
+    # ローカル埋め込みの場合はモデルを読み込んでおく（最初のリクエストで数秒待たせない）
+    await run_in_threadpool(llm_analyzer.embedder.warm_up)
+    analysis_coalescer.coalescer.start()
+    local_classifier.classifier.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    print(f"📊 DBプール統計: {database.get_pool_stats()} / async: {async_database.get_pool_stats()}")
+    await local_classifier.classifier.stop()
+    await analysis_coalescer.coalescer.stop()
+    await async_database.close_pool()
+    database.close_pool()
 
 # ▼▼▼【修正】場所を正確に指定するように変更 ▼▼▼
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -34,6 +57,10 @@ app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 # ▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲
 
+# 類似フィルターの判定方法: 'numpy' は行列積でページ単位にまとめて判定、'database' はpgvectorで判定、
+# 'python' は従来どおり投稿ごとにループする
+SIMILARITY_FILTER_MODE = os.getenv("SIMILARITY_FILTER_MODE", "numpy")
+
 def cosine_similarity(vec1, vec2):
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
@@ -48,15 +75,17 @@ def get_64_type(scores: dict) -> str:
     return f"{mbti_type}-{turbulence_assertiveness}{light_dark}"
 
 # --- フィルタリングロジックを関数化 ---
-def apply_filter_to_post(item, analysis_result, user_filter_settings, user_scores, unpleasant_uris, unpleasant_vectors):
+def apply_filter_to_post(item, analysis_result, context, similar_uris=None, personality_matches=None):
     item.is_mosaic = False
     item.analysis_info = None
 
-    SIMILARITY_THRESHOLD = user_filter_settings.get('similarity_threshold', 0.80)
-    hidden_content_manual = set(user_filter_settings.get('hidden_content_categories', []))
-    strength = user_filter_settings.get('filter_strength', 2)
+    SIMILARITY_THRESHOLD = context.similarity_threshold
+    hidden_content_manual = context.hidden_content_categories
+    strength = context.filter_strength
+    user_scores = context.scores
+    unpleasant_vectors = context.unpleasant_vectors
 
-    if item.post.uri in unpleasant_uris:
+    if item.post.uri in context.unpleasant_uris:
         item.is_mosaic = True
         item.analysis_info = {"type": "不快な投稿", "category": "あなたが報告した投稿"}
         return item
@@ -66,40 +95,48 @@ def apply_filter_to_post(item, analysis_result, user_filter_settings, user_score
 
     post_embedding = analysis_result.get("embedding")
     is_similar = False
-    if post_embedding is not None and unpleasant_vectors:
+    if similar_uris is not None:
+        is_similar = item.post.uri in similar_uris
+    elif post_embedding is not None and len(unpleasant_vectors):
         for unpleasant_vec in unpleasant_vectors:
             similarity = cosine_similarity(post_embedding, unpleasant_vec)
             if similarity > SIMILARITY_THRESHOLD:
                 is_similar = True
                 break
     
-    if user_filter_settings.get('similarity_filter_enabled') and is_similar:
+    if context.similarity_filter_enabled and is_similar:
         item.is_mosaic = True
         item.analysis_info = {"type": "類似フィルター", "category": "あなたが不快と報告した投稿に類似"}
     elif analysis_result.get("content_category") in hidden_content_manual:
         item.is_mosaic = True
         item.analysis_info = {"type": "手動フィルター", "category": analysis_result.get("content_category")}
-    elif user_filter_settings.get('auto_filter_enabled') and user_scores:
-        for trait, rules_by_level in personality_descriptions.FILTERING_RULES.items():
-            level = 'high' if user_scores.get(trait.lower(), 0) >= 3.0 else 'low'
-            rule_list = rules_by_level.get(level, [])
-            for rule in rule_list:
-                categories_to_hide = rule['categories'].get(strength, [])
-                category_key = ""
-                if rule['type'] == 'style': category_key = 'style_stance_category'
-                elif rule['type'] == 'expression': category_key = 'expression_category'
-                elif rule['type'] == 'content': category_key = 'content_category'
-
-                if category_key:
-                    post_category = analysis_result.get(category_key)
-                    if post_category in categories_to_hide:
-                        item.is_mosaic = True
-                        item.analysis_info = {"type": "性格診断フィルター", "category": post_category}
-                        break
-            if item.is_mosaic: break
+    elif context.auto_filter_enabled and user_scores:
+        if personality_matches is not None:
+            post_category = personality_matches.get(item.post.uri)
+        else:
+            post_category = filter_rules.match(analysis_result, user_scores, strength)
+        if post_category is not None:
+            item.is_mosaic = True
+            item.analysis_info = {"type": "性格診断フィルター", "category": post_category}
     
     return item
 
+def find_personality_matches(context, post_uris, analysis_results):
+    """性格診断フィルターをページ単位でまとめて判定する"""
+    if not context.auto_filter_enabled:
+        return {}
+    return filter_rules.page_matches(post_uris, analysis_results, context.scores, context.filter_strength)
+
+async def find_similar_uris(user_did, context, post_uris, embeddings):
+    """1ページ（1バッチ）分の候補をまとめて類似判定する（python モードでは None を返し投稿ごとに判定）"""
+    if SIMILARITY_FILTER_MODE == 'python':
+        return None
+    if not context.similarity_filter_enabled or not len(context.unpleasant_vectors):
+        return set()
+    if SIMILARITY_FILTER_MODE == 'database':
+        return await async_database.get_similar_post_uris(user_did, post_uris, context.similarity_threshold)
+    return similarity.find_similar_uris(post_uris, embeddings, context.unpleasant_vectors, context.similarity_threshold)
+
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     return RedirectResponse(url="/login") if 'user_did' not in request.session else RedirectResponse(url="/timeline")
@@ -120,7 +157,7 @@ async def login_process(request: Request, handle: str = Form(...), app_password:
         request.session['handle'] = user_profile['handle']
         request.session['display_name'] = user_profile.get('display_name') or user_profile.get('handle')
         request.session['app_password'] = app_password
-        has_result = database.get_user_result(user_profile['did'])
+        has_result = await async_database.get_user_result(user_profile['did'])
         return RedirectResponse(url="/timeline", status_code=303) if has_result else RedirectResponse(url="/quiz", status_code=303)
     return templates.TemplateResponse("login.html", {"request": request, "error": "ハンドルまたはアプリパスワードが間違っています。"})
 
@@ -136,7 +173,7 @@ async def submit_quiz(request: Request):
     answers = [int(form_data[f'q{i}']) for i in range(1, len(quiz_checker.QUESTIONS_DATA) + 1) if f'q{i}' in form_data]
     if len(answers) == len(quiz_checker.QUESTIONS_DATA):
         scores = quiz_checker.calculate_scores(answers)
-        database.add_or_update_hexaco_result(request.session['user_did'], request.session['handle'], scores)
+        await async_database.add_or_update_hexaco_result(request.session['user_did'], request.session['handle'], scores)
         return RedirectResponse(url="/results", status_code=303)
     return templates.TemplateResponse("quiz.html", {"request": request, "questions": quiz_checker.QUESTIONS_DATA, "error": "すべての質問に回答してください。"})
 
@@ -151,10 +188,7 @@ async def get_timeline_content(request: Request, cursor: str = None, feed_type:
 
     user_did = request.session['user_did']
     
-    user_filter_settings = database.get_user_filter_settings(user_did)
-    user_scores = database.get_user_result(user_did)
-    unpleasant_uris = set(database.get_unpleasant_feedback_uris(user_did))
-    unpleasant_vectors = database.get_unpleasant_post_vectors(user_did)
+    context = await async_database.load_user_filter_context(user_did)
     
     raw_feed, next_cursor = await run_in_threadpool(
         timeline_checker.get_timeline_data,
@@ -169,7 +203,12 @@ async def get_timeline_content(request: Request, cursor: str = None, feed_type:
         return templates.TemplateResponse("timeline_items.html", {"request": request, "feed": [], "hidden_post_count": 0, "total_post_count": 0, "analysis_results": {}, "next_cursor": None})
 
     all_post_uris = [item.post.uri for item in raw_feed if item.post and item.post.uri]
-    cached_results = database.get_cached_analysis_results(all_post_uris)
+    # ベクトルはこのワーカー内で類似判定するときだけ取得する
+    needs_embedding = SIMILARITY_FILTER_MODE != 'database' and context.similarity_filter_enabled and len(context.unpleasant_vectors) > 0
+    cached_results = await async_database.get_cached_analysis_results(all_post_uris, with_embedding=needs_embedding)
+    cached_uris = list(cached_results.keys())
+    similar_uris = await find_similar_uris(user_did, context, cached_uris, [cached_results[uri].get('embedding') for uri in cached_uris])
+    personality_matches = find_personality_matches(context, cached_uris, [cached_results[uri] for uri in cached_uris])
     
     processed_feed, hidden_post_count = [], 0
     for item in raw_feed:
@@ -181,8 +220,8 @@ async def get_timeline_content(request: Request, cursor: str = None, feed_type:
         item.analysis_info = None
         item.needs_analysis = False
 
-        if analysis_result or (item.post.uri in unpleasant_uris):
-            apply_filter_to_post(item, analysis_result, user_filter_settings, user_scores, unpleasant_uris, unpleasant_vectors)
+        if analysis_result or (item.post.uri in context.unpleasant_uris):
+            apply_filter_to_post(item, analysis_result, context, similar_uris, personality_matches)
             if item.is_mosaic: hidden_post_count += 1
         else:
             item.needs_analysis = True
@@ -206,6 +245,39 @@ class PostItem(BaseModel):
 class AnalyzeBatchPayload(BaseModel):
     items: List[PostItem] # 【修正】List型ヒントを使用
 
+async def analyze_texts_with_cache(uris: list[str], texts: list[str]):
+    """
+    本文ハッシュが一致する既存の分析結果を再利用し、残りだけをLLMに送る。
+    同じバッチ内で本文が重複する投稿もLLMには1回だけ送る。
+    LLMへの依頼は analysis_coalescer で他のセッションの依頼とまとめられ、処理中の投稿とは結果を共有する。
+    戻り値は (URIの順に並んだ分析結果, {URI: 本文ハッシュ})。
+    """
+    hashes = [text_hash.text_hash(text) for text in texts]
+    text_hashes = {uri: h for uri, h in zip(uris, hashes) if h}
+    known = await async_database.get_analysis_results_by_text_hash(list(set(text_hashes.values())))
+
+    results = [None] * len(texts)
+    pending = {}   # 本文ハッシュ（無ければURI）→ LLMに送る位置のリスト
+    hits = duplicates = 0
+    for i, h in enumerate(hashes):
+        if h and h in known:
+            results[i] = dict(known[h])
+            hits += 1
+            continue
+        key = h or uris[i]
+        if key in pending:
+            duplicates += 1
+        pending.setdefault(key, []).append(i)
+    text_hash.text_cache_stats.record(len(text_hashes), hits, duplicates)
+
+    if pending:
+        indices = [positions[0] for positions in pending.values()]
+        llm_results = await analysis_coalescer.coalescer.analyze(list(pending.keys()), [texts[i] for i in indices])
+        for positions, result in zip(pending.values(), llm_results):
+            for i in positions:
+                results[i] = result
+    return results, text_hashes
+
 @app.post("/api/analyze_posts_batch")
 async def analyze_batch_posts_api(request: Request, payload: AnalyzeBatchPayload):
     if 'user_did' not in request.session: return JSONResponse(content={"error": "Not logged in"}, status_code=401)
@@ -218,22 +290,19 @@ async def analyze_batch_posts_api(request: Request, payload: AnalyzeBatchPayload
     if not texts:
         return JSONResponse(content={"results": []})
 
-    # Gemini API呼び出し
-    llm_results = await run_in_threadpool(llm_analyzer.analyze_posts_batch, texts)
+    llm_results, text_hashes = await analyze_texts_with_cache(uris, texts)
     
-    user_filter_settings = database.get_user_filter_settings(user_did)
-    user_scores = database.get_user_result(user_did)
-    unpleasant_uris = set(database.get_unpleasant_feedback_uris(user_did))
-    unpleasant_vectors = database.get_unpleasant_post_vectors(user_did)
+    context = await async_database.load_user_filter_context(user_did)
     
+    await async_database.save_analysis_results_bulk(zip(uris, llm_results), text_hashes)
+    similar_uris = await find_similar_uris(user_did, context, uris, [result.get('embedding') if result else None for result in llm_results])
+    personality_matches = find_personality_matches(context, uris, llm_results)
+
     response_results = []
     
     for i, result in enumerate(llm_results):
         uri = uris[i]
         
-        if result:
-            database.save_analysis_results(uri, result)
-        
         class DummyPost: uri = ""
         class DummyItem:
             post = DummyPost()
@@ -243,7 +312,7 @@ async def analyze_batch_posts_api(request: Request, payload: AnalyzeBatchPayload
         dummy_item = DummyItem()
         dummy_item.post.uri = uri
         
-        apply_filter_to_post(dummy_item, result, user_filter_settings, user_scores, unpleasant_uris, unpleasant_vectors)
+        apply_filter_to_post(dummy_item, result, context, similar_uris, personality_matches)
         
         response_results.append({
             "uri": uri,
@@ -255,6 +324,26 @@ async def analyze_batch_posts_api(request: Request, payload: AnalyzeBatchPayload
     
     return JSONResponse(content={"results": response_results})
 
+# --- 運用メトリクス ---
+@app.get("/api/metrics")
+async def get_metrics(request: Request):
+    if 'user_did' not in request.session: return JSONResponse(content={"error": "Not logged in"}, status_code=401)
+    # プールのサイズ調整用に、ワーカーごとの待ち時間を返す
+    return JSONResponse(content={
+        "db_pool": database.get_pool_stats(),
+        "async_db_pool": async_database.get_pool_stats(),
+        "filter_context_cache": filter_context.context_cache.stats(),
+        "text_hash_cache": text_hash.text_cache_stats.stats(),
+        "analysis_coalescer": analysis_coalescer.coalescer.stats(),
+        "llm_batch_planner": batch_planner.planner.stats(),
+        "llm_recovery": llm_analyzer.get_recovery_stats(),
+        "prompt_preprocess": text_preprocess.preprocess_stats.stats(),
+        "embedding": llm_analyzer.embedder.stats(),
+        "local_classifier": local_classifier.classifier.stats(),
+        "label_propagation": label_propagation.propagator.stats(),
+        "gemini_keys": llm_analyzer.key_pool.stats(),
+    })
+
 # ... (ログアウト以下のコードは既存と同じ) ...
 @app.get("/logout")
 async def logout(request: Request):
@@ -264,7 +353,7 @@ async def logout(request: Request):
 @app.get("/results", response_class=HTMLResponse)
 async def show_results(request: Request):
     if 'user_did' not in request.session: return RedirectResponse(url="/login")
-    result = database.get_user_result(request.session['user_did'])
+    result = await async_database.get_user_result(request.session['user_did'])
     if not result: return RedirectResponse(url="/quiz")
     scores = { 'H': result.get('h',0), 'E': result.get('e',0), 'X': result.get('x',0), 'A': result.get('a',0), 'C': result.get('c',0), 'O': result.get('o',0) }
     type_code = get_64_type(scores)
@@ -275,19 +364,9 @@ async def show_results(request: Request):
 async def show_settings(request: Request):
     if 'user_did' not in request.session: return RedirectResponse(url="/login")
     user_did = request.session['user_did']
-    user_settings = database.get_user_filter_settings(user_did)
-    user_scores = database.get_user_result(user_did)
-    active_rules = {}
-    if user_scores:
-        strength = user_settings.get('filter_strength', 2)
-        for trait, rules_by_level in personality_descriptions.FILTERING_RULES.items():
-            level = 'high' if user_scores.get(trait.lower(), 0) >= 3.0 else 'low'
-            rule_list = rules_by_level.get(level, [])
-            merged_categories = []
-            for rule in rule_list:
-                merged_categories.extend(rule['categories'].get(strength, []))
-            if merged_categories:
-                active_rules[rules_by_level['name']] = list(set(merged_categories))
+    user_settings = await async_database.get_user_filter_settings(user_did)
+    user_scores = await async_database.get_user_result(user_did)
+    active_rules = filter_rules.active_rules(user_scores, user_settings.get('filter_strength', 2))
     return templates.TemplateResponse("settings.html", {"request": request, "user_settings": user_settings, "all_content_categories": llm_analyzer.CONTENT_CATEGORIES, "active_rules": active_rules})
 
 @app.post("/settings")
@@ -300,21 +379,11 @@ async def save_settings(request: Request):
     filter_strength = int(form_data.get("filter_strength", 2))
     similarity_threshold = float(form_data.get("similarity_threshold", 0.80))
     
-    database.save_user_filter_settings(request.session['user_did'], hidden_content, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold)
+    await async_database.save_user_filter_settings(request.session['user_did'], hidden_content, auto_filter_enabled, similarity_filter_enabled, filter_strength, similarity_threshold)
     
-    user_settings = database.get_user_filter_settings(request.session['user_did'])
-    user_scores = database.get_user_result(request.session['user_did'])
-    active_rules = {}
-    if user_scores:
-        strength = user_settings.get('filter_strength', 2)
-        for trait, rules_by_level in personality_descriptions.FILTERING_RULES.items():
-            level = 'high' if user_scores.get(trait.lower(), 0) >= 3.0 else 'low'
-            rule_list = rules_by_level.get(level, [])
-            merged_categories = []
-            for rule in rule_list:
-                merged_categories.extend(rule['categories'].get(strength, []))
-            if merged_categories:
-                active_rules[rules_by_level['name']] = list(set(merged_categories))
+    user_settings = await async_database.get_user_filter_settings(request.session['user_did'])
+    user_scores = await async_database.get_user_result(request.session['user_did'])
+    active_rules = filter_rules.active_rules(user_scores, user_settings.get('filter_strength', 2))
     return templates.TemplateResponse("settings.html", {"request": request, "user_settings": user_settings, "all_content_categories": llm_analyzer.CONTENT_CATEGORIES, "active_rules": active_rules, "save_success": True})
 
 class ReportPayload(BaseModel):
@@ -327,14 +396,14 @@ class FeedbackPayload(BaseModel):
 @app.post("/report_filter_feedback")
 async def report_filter_feedback(request: Request, payload: FeedbackPayload):
     if 'user_did' not in request.session: return JSONResponse(content={"success": False, "error": "Not logged in"}, status_code=401)
-    database.add_filter_feedback(user_did=request.session['user_did'], post_uri=payload.uri, filter_type=payload.filter_type, feedback=payload.feedback)
+    await async_database.add_filter_feedback(user_did=request.session['user_did'], post_uri=payload.uri, filter_type=payload.filter_type, feedback=payload.feedback)
     return JSONResponse(content={"success": True})
 
 @app.post("/report_unpleasant")
 async def report_unpleasant(request: Request, payload: ReportPayload):
     if 'user_did' not in request.session: return JSONResponse(content={"success": False, "error": "Not logged in"}, status_code=401)
     user_did = request.session['user_did']
-    database.add_unpleasant_feedback(user_did, payload.uri)
+    await async_database.add_unpleasant_feedback(user_did, payload.uri)
     return JSONResponse(content={"success": True})
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+# migrations.py
+# バージョン付きのスキーマ移行。適用済みのバージョンは schema_migrations テーブルに記録し、
+# 起動時には未適用のものだけを実行する（全て適用済みなら確認クエリだけで終わる）。
+# どの移行も IF NOT EXISTS 等で再実行しても安全なように書くこと。
+
+import psycopg2
+import psycopg2.extensions
+
+# 複数ワーカーが同時に起動しても1つだけが移行を実行するためのアドバイザリーロックのキー
+MIGRATION_LOCK_KEY = 727_001
+
+MIGRATIONS = [
+    (1, "初期テーブル", [
+        "CREATE EXTENSION IF NOT EXISTS vector",
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_did TEXT PRIMARY KEY, handle TEXT NOT NULL, created_at TIMESTAMPTZ NOT NULL
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS hexaco_results (
+            result_id SERIAL PRIMARY KEY, user_did TEXT NOT NULL,
+            H REAL NOT NULL, E REAL NOT NULL, X REAL NOT NULL,
+            A REAL NOT NULL, C REAL NOT NULL, O REAL NOT NULL,
+            diagnosed_at TIMESTAMPTZ NOT NULL,
+            FOREIGN KEY (user_did) REFERENCES users (user_did)
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS filter_settings (
+            setting_id SERIAL PRIMARY KEY, user_did TEXT NOT NULL UNIQUE,
+            hidden_content_categories TEXT[] NOT NULL,
+            auto_filter_enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            similarity_filter_enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            filter_strength INTEGER NOT NULL DEFAULT 2,
+            similarity_threshold REAL NOT NULL DEFAULT 0.80,
+            updated_at TIMESTAMPTZ NOT NULL,
+            FOREIGN KEY (user_did) REFERENCES users (user_did)
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS post_analysis_cache (
+            post_uri TEXT PRIMARY KEY, content_category TEXT NOT NULL,
+            expression_category TEXT NOT NULL, style_stance_category TEXT NOT NULL,
+            embedding vector(768),
+            analyzed_at TIMESTAMPTZ NOT NULL
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS unpleasant_feedback (
+            feedback_id SERIAL PRIMARY KEY, user_did TEXT NOT NULL, post_uri TEXT NOT NULL,
+            reported_at TIMESTAMPTZ NOT NULL,
+            FOREIGN KEY (user_did) REFERENCES users (user_did),
+            FOREIGN KEY (post_uri) REFERENCES post_analysis_cache (post_uri)
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS filter_feedback (
+            feedback_id SERIAL PRIMARY KEY,
+            user_did TEXT NOT NULL,
+            post_uri TEXT NOT NULL,
+            filter_type TEXT NOT NULL,
+            feedback TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL,
+            FOREIGN KEY (user_did) REFERENCES users (user_did)
+        )''',
+    ]),
+    (2, "類似検索用のHNSWインデックス", [
+        '''
+        CREATE INDEX IF NOT EXISTS post_analysis_cache_embedding_hnsw_idx
+        ON post_analysis_cache USING hnsw (embedding vector_cosine_ops)''',
+    ]),
+    (3, "よく使う検索条件のインデックス", [
+        # 同じ投稿の重複報告を1件にまとめてから一意インデックスを張る（add_unpleasant_feedback の ON CONFLICT 用）
+        '''
+        DELETE FROM unpleasant_feedback AS dup USING unpleasant_feedback AS keep
+        WHERE dup.user_did = keep.user_did AND dup.post_uri = keep.post_uri
+          AND dup.feedback_id > keep.feedback_id''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS unpleasant_feedback_user_post_key ON unpleasant_feedback (user_did, post_uri)",
+        "CREATE INDEX IF NOT EXISTS unpleasant_feedback_post_uri_idx ON unpleasant_feedback (post_uri)",
+        # 最新の診断結果をインデックスだけで取得できるようにスコアも含める
+        "CREATE INDEX IF NOT EXISTS hexaco_results_user_latest_idx ON hexaco_results (user_did, diagnosed_at DESC) INCLUDE (h, e, x, a, c, o)",
+        # analysis/ の集計スクリプト用
+        "CREATE INDEX IF NOT EXISTS filter_feedback_feedback_type_idx ON filter_feedback (feedback, filter_type)",
+        "CREATE INDEX IF NOT EXISTS filter_feedback_post_uri_idx ON filter_feedback (post_uri)",
+        "CREATE INDEX IF NOT EXISTS filter_feedback_user_did_idx ON filter_feedback (user_did)",
+        "CREATE INDEX IF NOT EXISTS filter_feedback_created_at_idx ON filter_feedback (created_at DESC)",
+    ]),
+    (4, "埋め込みを半精度 (halfvec) で保存", [
+        # halfvec は pgvector 0.7.0 以降で利用できる。
+        # 既に halfvec の列は変換しない（再実行でテーブルの書き換えとインデックスの再構築をしない。
+        # ALTER EXTENSION は拡張の所有者でないと失敗するので、変換が必要なときだけ実行する）
+        '''
+        DO $$
+        BEGIN
+            IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = 'post_analysis_cache'::regclass AND attname = 'embedding' AND NOT attisdropped)
+               IS DISTINCT FROM 'halfvec(768)' THEN
+                ALTER EXTENSION vector UPDATE;
+                DROP INDEX IF EXISTS post_analysis_cache_embedding_hnsw_idx;
+                ALTER TABLE post_analysis_cache ALTER COLUMN embedding TYPE halfvec(768) USING embedding::halfvec(768);
+            END IF;
+        END
+        $$''',
+        '''
+        CREATE INDEX IF NOT EXISTS post_analysis_cache_embedding_hnsw_idx
+        ON post_analysis_cache USING hnsw (embedding halfvec_cosine_ops)''',
+    ]),
+    (5, "本文ハッシュで分析結果を引けるようにする", [
+        "ALTER TABLE post_analysis_cache ADD COLUMN IF NOT EXISTS text_hash TEXT",
+        "CREATE INDEX IF NOT EXISTS post_analysis_cache_text_hash_idx ON post_analysis_cache (text_hash, analyzed_at DESC) WHERE text_hash IS NOT NULL",
+    ]),
+    (6, "埋め込みのモデルと次元数を記録する", [
+        "ALTER TABLE post_analysis_cache ADD COLUMN IF NOT EXISTS embedding_model TEXT",
+        "ALTER TABLE post_analysis_cache ADD COLUMN IF NOT EXISTS embedding_dim INTEGER",
+        # これまでの埋め込みは全て Gemini の text-embedding-004 (768次元)
+        '''
+        UPDATE post_analysis_cache SET embedding_model = 'models/text-embedding-004', embedding_dim = 768
+        WHERE embedding IS NOT NULL AND embedding_model IS NULL''',
+    ]),
+    (7, "カテゴリを付けた経路を記録する", [
+        # 'llm'・'local_classifier'・'knn'・'unclassifiable'（LLMで分類できず確定したもの）のいずれか。これまでの行は全てLLMが付けたもの
+        "ALTER TABLE post_analysis_cache ADD COLUMN IF NOT EXISTS label_source TEXT NOT NULL DEFAULT 'llm'",
+    ]),
+    (8, "本文ハッシュとモデルごとの埋め込みキャッシュ", [
+        '''
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            text_hash TEXT NOT NULL,
+            embedding_model TEXT NOT NULL,
+            embedding halfvec(768) NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (text_hash, embedding_model)
+        )''',
+        # 分析結果として保存済みの埋め込みを引き継ぐ
+        '''
+        INSERT INTO embedding_cache (text_hash, embedding_model, embedding, created_at)
+        SELECT DISTINCT ON (text_hash, embedding_model) text_hash, embedding_model, embedding, analyzed_at
+        FROM post_analysis_cache
+        WHERE text_hash IS NOT NULL AND embedding_model IS NOT NULL AND embedding IS NOT NULL
+        ORDER BY text_hash, embedding_model, analyzed_at DESC
+        ON CONFLICT DO NOTHING''',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def _cursor(conn):
+    """行をタプルで返すカーソル（プールの接続は RealDictCursor が既定なので、呼び出し側の設定に依存しないようにする）"""
+    return conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+
+def _ensure_migrations_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )''')
+
+def applied_versions(cursor) -> set[int]:
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return set()
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+def current_version(cursor) -> int:
+    return max(applied_versions(cursor), default=0)
+
+def _pending(cursor) -> list:
+    applied = applied_versions(cursor)
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+def migrate(conn) -> int:
+    """
+    未適用の移行を順に適用し、適用後のバージョンを返す。各移行は1トランザクションで実行する。
+    reset() で記録を消したバージョンは、それより新しいバージョンが適用済みでも再実行する。
+    """
+    cursor = _cursor(conn)
+    pending = _pending(cursor)
+    conn.commit()
+    if not pending:
+        version = current_version(cursor)
+        conn.commit()
+        print(f"✅ スキーマは最新です (version {version})")
+        cursor.close()
+        return version
+
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        _ensure_migrations_table(cursor)
+        conn.commit()
+        # ロック待ちの間に他のワーカーが適用している場合があるので読み直す
+        pending = _pending(cursor)
+        conn.commit()
+        for migration_version, description, statements in pending:
+            print(f"🛠️ 移行 {migration_version}: {description} を適用中...")
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (migration_version, description)
+                )
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                print(f"❌ 移行 {migration_version} に失敗しました: {e}")
+                break
+        version = current_version(cursor)
+        conn.commit()
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+    return version
+
+def reset(conn, versions: list[int]):
+    """
+    指定したバージョンの適用記録だけを消し、次回起動時にそれらの移行を再実行させる。
+    maintenance/ のスクリプトでテーブルを DROP するときに、そのテーブルを作る・変更する移行を指定して呼ぶ。
+    DROP と同じトランザクションで実行するため、ここでは commit しない（呼び出し側でまとめて commit する）。
+    """
+    cursor = _cursor(conn)
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        cursor.execute("DELETE FROM schema_migrations WHERE version = ANY(%s)", (list(versions),))
+    cursor.close()
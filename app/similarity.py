@@ -0,0 +1,51 @@
+# similarity.py
+# 類似フィルター用のベクトル演算。1ページ分の投稿をまとめて行列積で判定する。
+
+import numpy as np
+
+# 報告数が極端に多い場合でもメモリを抑えるため、報告ベクトルをこの件数ずつ処理する
+REPORT_CHUNK_SIZE = 4096
+
+def normalize_rows(matrix) -> np.ndarray:
+    """各行をL2正規化した float32 行列を返す（ゼロベクトルはゼロのまま）"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.size == 0:
+        return matrix.reshape(0, matrix.shape[1] if matrix.ndim == 2 else 0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def stack_embeddings(embeddings: list) -> tuple[np.ndarray, np.ndarray]:
+    """
+    埋め込みのリスト（None を含んでよい）を正規化済みの行列にまとめる。
+    戻り値は (有効な埋め込みの行列, 元のリストのどの位置が有効かを示すインデックス配列)。
+    """
+    valid_indices = [i for i, emb in enumerate(embeddings) if emb is not None and len(emb)]
+    if not valid_indices:
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.intp)
+    matrix = np.stack([np.asarray(embeddings[i], dtype=np.float32) for i in valid_indices])
+    return normalize_rows(matrix), np.asarray(valid_indices, dtype=np.intp)
+
+def similar_mask(post_matrix: np.ndarray, unpleasant_matrix: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    正規化済みの投稿行列 (N, D) と報告行列 (M, D) から、
+    いずれかの報告とのコサイン類似度が threshold を超える投稿を True とするマスク (N,) を返す。
+    """
+    n_posts = post_matrix.shape[0]
+    mask = np.zeros(n_posts, dtype=bool)
+    if n_posts == 0 or unpleasant_matrix.size == 0:
+        return mask
+    for start in range(0, unpleasant_matrix.shape[0], REPORT_CHUNK_SIZE):
+        chunk = unpleasant_matrix[start:start + REPORT_CHUNK_SIZE]
+        mask |= (post_matrix @ chunk.T).max(axis=1) > threshold
+    return mask
+
+def find_similar_uris(uris: list[str], embeddings: list, unpleasant_matrix: np.ndarray, threshold: float) -> set[str]:
+    """URIと埋め込みの並びを受け取り、報告済み投稿に類似するURIの集合を返す"""
+    if unpleasant_matrix.size == 0:
+        return set()
+    post_matrix, valid_indices = stack_embeddings(embeddings)
+    if post_matrix.size == 0 or post_matrix.shape[1] != unpleasant_matrix.shape[1]:
+        return set()
+    mask = similar_mask(post_matrix, unpleasant_matrix, threshold)
+    return {uris[i] for i in valid_indices[mask]}
@@ -0,0 +1,52 @@
+# text_hash.py
+# 投稿本文を正規化してハッシュ化する。コピペ・bot・クロスポストなど本文が同じ投稿の分析結果を使い回すためのキー。
+
+import hashlib
+import re
+import threading
+import unicodedata
+
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    """NFKC正規化 → URL除去 → 空白の連続を1つにまとめる"""
+    if not text:
+        return ""
+    text = unicodedata.normalize('NFKC', text)
+    text = URL_PATTERN.sub(' ', text)
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def text_hash(text: str) -> str | None:
+    """正規化した本文の SHA-256。正規化後に空になる投稿（URLだけ等）は None"""
+    normalized = normalize_text(text)
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+class TextCacheStats:
+    """本文ハッシュキャッシュのヒット率（ワーカープロセス単位）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lookups = 0           # ハッシュを計算できた投稿数
+        self.hits = 0              # DBの既存結果を再利用できた投稿数
+        self.batch_duplicates = 0  # 同じバッチ内の重複としてLLM呼び出しを省いた投稿数
+
+    def record(self, lookups: int, hits: int, batch_duplicates: int):
+        with self._lock:
+            self.lookups += lookups
+            self.hits += hits
+            self.batch_duplicates += batch_duplicates
+
+    def stats(self) -> dict:
+        with self._lock:
+            saved = self.hits + self.batch_duplicates
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'batch_duplicates': self.batch_duplicates,
+                'hit_rate': saved / self.lookups if self.lookups else 0.0,
+            }
+
+text_cache_stats = TextCacheStats()
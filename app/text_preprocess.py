@@ -0,0 +1,144 @@
+# text_preprocess.py
+# 分類プロンプトに貼る前に投稿本文を短くする。分類に効かない部分（長いURL・連続する同じ文字や絵文字・
+# ハッシュタグの羅列・空白や改行）を削り、それでも長い投稿は先頭と末尾を残して中間を省く。
+# 1件あたりのトークン数が減るぶん、batch_planner が1回の呼び出しに載せられる投稿数が増える。
+# 埋め込み・本文ハッシュには元の本文を使う（ここで変えるのは分類プロンプトに貼る本文だけ）。
+
+import functools
+import os
+import re
+import threading
+from urllib.parse import urlsplit
+
+ENABLED = os.getenv('LLM_PREPROCESS_ENABLED', '1') == '1'
+URL_MODE = os.getenv('LLM_PREPROCESS_URLS', 'domain')                      # domain: ドメインだけ残す / strip: 消す / keep: そのまま
+POST_TOKEN_BUDGET = int(os.getenv('LLM_POST_TOKEN_BUDGET', '160'))          # 1投稿あたりのトークン数の上限（0 なら切り詰めない）
+HEAD_FRACTION = float(os.getenv('LLM_POST_HEAD_FRACTION', '0.7'))           # 切り詰めるときに先頭に残す割合（残りは末尾）
+LOG_BATCHES = os.getenv('LLM_PREPROCESS_LOG', '0') == '1'                  # 1 なら分類バッチごとの内訳も出力する
+MAX_REPEAT = 3        # 同じ文字（2文字までの繰り返し単位）はこの回数まで残す
+MAX_HASHTAGS = 3      # 連続するハッシュタグはこの個数まで残す
+
+# トークン数の概算（日本語はおおむね1〜2文字で1トークン）
+CHARS_PER_TOKEN = 1.5
+
+# 日本語が URL の直後に続く場合に巻き込まないよう、URLに使える ASCII 文字だけを対象にする
+URL_PATTERN = re.compile(r"(?:https?://|www\.)[A-Za-z0-9\-._~:/?#\[\]@!$&'()*+,;=%]+")
+# 数字の連続（金額・年号など）は意味が変わるので縮めない
+REPEAT_PATTERN = re.compile(r'([^\d\s]{1,2}?)\1{%d,}' % MAX_REPEAT)
+HASHTAG_PATTERN = re.compile(r'[#＃]\S+')
+HASHTAG_RUN_PATTERN = re.compile(r'(?:[#＃]\S+\s*){%d,}' % (MAX_HASHTAGS + 1))
+WHITESPACE_PATTERN = re.compile(r'\s+')
+ELLIPSIS = '…'
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+def _shorten_url(match: re.Match) -> str:
+    if URL_MODE == 'strip':
+        return ' '
+    url = match.group(0)
+    host = urlsplit(url if '://' in url else 'http://' + url).hostname or ''
+    host = host.removeprefix('www.')
+    return f' [URL:{host}] ' if host else ' [URL] '
+
+def _squeeze_hashtags(match: re.Match) -> str:
+    tags = HASHTAG_PATTERN.findall(match.group(0))
+    return ' '.join(tags[:MAX_HASHTAGS]) + f' {ELLIPSIS} '
+
+def _max_chars(max_tokens: int) -> int:
+    return int(max_tokens * CHARS_PER_TOKEN)
+
+def needs_truncation(text: str, max_tokens: int = POST_TOKEN_BUDGET) -> bool:
+    return max_tokens > 0 and len(text) > _max_chars(max_tokens)
+
+def truncate(text: str, max_tokens: int = POST_TOKEN_BUDGET) -> str:
+    """推定トークン数が上限を超えたら、先頭と末尾を残して中間を「…」で省く"""
+    if not needs_truncation(text, max_tokens):
+        return text
+    max_chars = _max_chars(max_tokens)
+    head = int((max_chars - 1) * HEAD_FRACTION)
+    tail = max_chars - 1 - head
+    return text[:head].rstrip() + ELLIPSIS + (text[-tail:].lstrip() if tail > 0 else '')
+
+@functools.lru_cache(maxsize=8192)
+def normalize(text: str) -> str:
+    """URLの短縮 → 繰り返しの圧縮 → ハッシュタグの羅列の圧縮 → 空白をまとめる"""
+    if not text:
+        return text
+    if URL_MODE != 'keep':
+        text = URL_PATTERN.sub(_shorten_url, text)
+    text = REPEAT_PATTERN.sub(r'\1' * MAX_REPEAT, text)
+    text = HASHTAG_RUN_PATTERN.sub(_squeeze_hashtags, text)
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def preprocess(text: str) -> str:
+    """分類プロンプトに貼る本文（正規化してから先頭+末尾で切り詰める）"""
+    if not ENABLED or not text:
+        return text
+    return truncate(normalize(text))
+
+class PreprocessStats:
+    """前処理で削ったトークン数の累計（プロセス単位）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.posts = 0
+        self.truncated_posts = 0
+        self.original_tokens = 0
+        self.reduced_tokens = 0
+
+    def record(self, posts: int, truncated_posts: int, original_tokens: int, reduced_tokens: int):
+        with self._lock:
+            self.posts += posts
+            self.truncated_posts += truncated_posts
+            self.original_tokens += original_tokens
+            self.reduced_tokens += reduced_tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'enabled': ENABLED,
+                'url_mode': URL_MODE,
+                'post_token_budget': POST_TOKEN_BUDGET,
+                'posts': self.posts,
+                'truncated_posts': self.truncated_posts,
+                'original_tokens': self.original_tokens,
+                'reduced_tokens': self.reduced_tokens,
+                'reduction_rate': 1 - self.reduced_tokens / self.original_tokens if self.original_tokens else 0.0,
+            }
+
+preprocess_stats = PreprocessStats()
+
+def _measure(texts: list[str]) -> tuple[list[str], int, int, int]:
+    """(前処理後の本文, 元の推定トークン数, 前処理後の推定トークン数, 切り詰めた件数)"""
+    normalized = [normalize(text) for text in texts]
+    processed = [truncate(text) if text else text for text in normalized]
+    original = sum(estimate_tokens(text) for text in texts if text)
+    reduced = sum(estimate_tokens(text) for text in processed if text)
+    truncated = sum(1 for text in normalized if text and needs_truncation(text))
+    return processed, original, reduced, truncated
+
+def _print(label: str, posts: int, original: int, reduced: int, truncated: int):
+    print(f"✂️ 入力の前処理{label}: {posts}件 {original} → {reduced} トークン "
+          f"({1 - reduced / original:.0%} 削減, 切り詰め {truncated}件)")
+
+def log_summary(texts: list[str]):
+    """分析の呼び出し1回分（analyze_posts_batch・まとめ処理への依頼）の元と前処理後の推定トークン数を出力する"""
+    if not ENABLED or not texts:
+        return
+    _, original, reduced, truncated = _measure(texts)
+    if original:
+        _print('', len(texts), original, reduced, truncated)
+
+def preprocess_batch(texts: list[str]) -> list[str]:
+    """
+    分類ステージに渡す本文をまとめて前処理し、元と前処理後の推定トークン数を preprocess_stats に加える
+    （累計は /api/metrics の prompt_preprocess。バッチごとの内訳は LLM_PREPROCESS_LOG=1 のときだけ出す）
+    """
+    if not ENABLED:
+        return texts
+    processed, original, reduced, truncated = _measure(texts)
+    preprocess_stats.record(len(texts), truncated, original, reduced)
+    if LOG_BATCHES and original:
+        _print(' (分類バッチ)', len(texts), original, reduced, truncated)
+    return processed
@@ -1,21 +1,15 @@
 # delete_cache.py
 import os
-import psycopg2
-from dotenv import load_dotenv
+import sys
 
-load_dotenv()
-
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASS = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = os.getenv('POSTGRES_HOST')
+# 親ディレクトリ（ルート）をパスに追加して app モジュールをインポートできるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app.database as database
 
 def delete_cache_and_related_feedback():
     """unpleasant_feedbackテーブルとpost_analysis_cacheテーブルの全データを削除する"""
     try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST
-        )
+        conn = database.get_connection()
         cur = conn.cursor()
 
         # ▼▼▼【追加】unpleasant_feedbackテーブルのデータを先に削除 ▼▼▼
@@ -1,34 +1,33 @@
 import os
-import psycopg2
-from dotenv import load_dotenv
+import sys
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASS = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = os.getenv('POSTGRES_HOST')
+# 親ディレクトリ（ルート）をパスに追加して app モジュールをインポートできるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app.database as database
+from app import migrations
 
 def delete_table():
     """filter_settingsテーブルを削除する"""
+    conn = None
     try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS,
-            host=DB_HOST
-        )
+        conn = database.get_connection()
         cursor = conn.cursor()
         
         # テーブルを削除するSQLクエリを実行
         cursor.execute("DROP TABLE IF EXISTS filter_settings;")
-        
-        conn.commit()
         cursor.close()
-        conn.close()
+        # 次回起動時にテーブルを作り直させる（filter_settings を作るのは移行 1 だけ）。
+        # DROP と同じトランザクションで適用記録を消す
+        migrations.reset(conn, [1])
+        conn.commit()
         print("✅ filter_settings テーブルを正常に削除しました。")
     except Exception as e:
+        if conn is not None:
+            conn.rollback()
         print(f"エラーが発生しました: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
 
 if __name__ == '__main__':
     delete_table()
\ No newline at end of file
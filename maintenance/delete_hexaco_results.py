@@ -1,21 +1,12 @@
 import os
-import psycopg2
-from dotenv import load_dotenv
+import sys
 
-load_dotenv()
-
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASS = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = os.getenv('POSTGRES_HOST')
+# 親ディレクトリ（ルート）をパスに追加して app モジュールをインポートできるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app.database as database
 
 def delete_all_results():
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        host=DB_HOST
-    )
+    conn = database.get_connection()
     cur = conn.cursor()
     cur.execute("DELETE FROM hexaco_results;")
     conn.commit()
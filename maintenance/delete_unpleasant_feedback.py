@@ -1,14 +1,11 @@
 # delete_unpleasant_feedback.py (ファイル名を変更せず、この内容に更新)
 import os
-import psycopg2
-from dotenv import load_dotenv
+import sys
 
-load_dotenv()
-
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASS = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = os.getenv('POSTGRES_HOST')
+# 親ディレクトリ（ルート）をパスに追加して app モジュールをインポートできるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app.database as database
+from app import migrations
 
 def delete_dependent_tables():
     """依存関係のあるテーブルを正しい順序で削除する"""
@@ -19,10 +16,9 @@ def delete_dependent_tables():
         "post_analysis_cache"
     ]
     
+    conn = None
     try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST
-        )
+        conn = database.get_connection()
         cur = conn.cursor()
         
         for table in tables_to_delete:
@@ -30,13 +26,21 @@ def delete_dependent_tables():
             cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
             print(f"✅ Table {table} deleted successfully.")
             
-        conn.commit()
         cur.close()
-        conn.close()
+        # 次回起動時にテーブルとインデックスを作り直させる
+        # （3つのテーブルを作る・列やインデックスを追加する移行 1〜7。移行 8 の embedding_cache は残っている）。
+        # DROP と同じトランザクションで適用記録を消す
+        migrations.reset(conn, [1, 2, 3, 4, 5, 6, 7])
+        conn.commit()
         print("\nAll dependent tables have been successfully deleted.")
         
     except Exception as e:
+        if conn is not None:
+            conn.rollback()
         print(f"An error occurred: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
 
 if __name__ == "__main__":
     delete_dependent_tables()
\ No newline at end of file
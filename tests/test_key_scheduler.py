@@ -0,0 +1,62 @@
+# test_key_scheduler.py
+# key_scheduler はキーごとのクライアントを google-generativeai の内部の属性で差し替えている。
+# ライブラリを更新して差し替えが効かなくなった（共有クライアントが使われる）場合にここで失敗させる。
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+genai = pytest.importorskip("google.generativeai")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from google.api_core import exceptions
+from google.generativeai import protos
+
+from app import key_scheduler
+
+def _response() -> protos.GenerateContentResponse:
+    return protos.GenerateContentResponse(candidates=[
+        protos.Candidate(content=protos.Content(parts=[protos.Part(text='[]')], role='model'), finish_reason=1)
+    ])
+
+class _FakeClient:
+    def __init__(self):
+        self.requests = []
+
+    def generate_content(self, request, **kwargs):
+        self.requests.append(request)
+        return _response()
+
+class _FakeAsyncClient(_FakeClient):
+    async def generate_content(self, request, **kwargs):
+        self.requests.append(request)
+        return _response()
+
+def test_client_manager_is_available():
+    api_key = key_scheduler.ApiKey(0, 'test-key-0000')
+    assert hasattr(api_key._clients, 'configure')
+    assert hasattr(api_key._clients, 'get_default_client')
+
+def test_generative_model_uses_the_replaced_client():
+    model = genai.GenerativeModel(key_scheduler.GENERATION_MODEL)
+    fake = _FakeClient()
+    model._client = fake
+    assert model.generate_content('test').text == '[]'
+    assert len(fake.requests) == 1
+
+def test_generative_model_uses_the_replaced_async_client():
+    model = genai.GenerativeModel(key_scheduler.GENERATION_MODEL)
+    fake = _FakeAsyncClient()
+    model._async_client = fake
+    response = asyncio.run(model.generate_content_async('test'))
+    assert response.text == '[]'
+    assert len(fake.requests) == 1
+
+def test_invalid_key_errors():
+    assert key_scheduler.is_invalid_key_error(exceptions.InvalidArgument('API key not valid. Please pass a valid API key.'))
+    assert key_scheduler.is_invalid_key_error(exceptions.PermissionDenied('API_KEY_INVALID'))
+    # リクエストの内容の誤りによる 400 はキーの問題ではない
+    assert not key_scheduler.is_invalid_key_error(exceptions.InvalidArgument('400 Request contains an invalid argument.'))
+    assert not key_scheduler.is_invalid_key_error(ValueError('400'))
@@ -0,0 +1,78 @@
+# test_similar_post_uris.py
+# 類似投稿の判定 (database.SIMILAR_POST_URIS_QUERY) を pgvector 入りの PostgreSQL で確かめる。
+# POSTGRES_* の接続先が無い環境ではスキップする。使い捨てのスキーマに移行を適用して実行し、最後に削除する。
+
+import os
+import sys
+import uuid
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+pytest.importorskip("pgvector")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import database
+from app import migrations
+
+DIMENSION = 768
+MODEL = 'test-model'
+USER_DID = 'did:plc:test-user'
+N_CANDIDATES = 60   # hnsw.ef_search（既定 40）より多くする
+
+def _vector(values) -> str:
+    return '[' + ','.join(f'{v:.4f}' for v in values) + ']'
+
+@pytest.fixture
+def conn():
+    if not os.getenv('POSTGRES_HOST'):
+        pytest.skip("POSTGRES_HOST が設定されていません")
+    try:
+        conn = psycopg2.connect(dbname=database.DB_NAME, user=database.DB_USER,
+                                password=database.DB_PASS, host=database.DB_HOST)
+    except psycopg2.Error as e:
+        pytest.skip(f"PostgreSQL に接続できません: {e}")
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    cursor = conn.cursor()
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    cursor.execute(f"CREATE SCHEMA {schema}")
+    cursor.execute(f"SET search_path TO {schema}, public")
+    conn.commit()
+    migrations.migrate(conn)
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        cursor.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+def test_no_page_match_is_lost_beyond_ef_search(conn):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO users (user_did, handle, created_at) VALUES (%s, 'tester', now())", (USER_DID,))
+
+    # 報告した投稿と、それにほぼ同じ向きの候補を N_CANDIDATES 件、さらに無関係な投稿を入れる
+    reported = [1.0] + [0.0] * (DIMENSION - 1)
+    rows = [('at://reported', reported)]
+    rows += [(f'at://similar/{i}', [1.0] + [0.0] * i + [0.001 * (i + 1)] + [0.0] * (DIMENSION - i - 2))
+             for i in range(N_CANDIDATES)]
+    rows += [(f'at://other/{i}', [0.0] * (i + 1) + [1.0] + [0.0] * (DIMENSION - i - 2)) for i in range(N_CANDIDATES)]
+    for uri, values in rows:
+        cursor.execute(
+            "INSERT INTO post_analysis_cache (post_uri, content_category, expression_category, style_stance_category,"
+            " embedding, embedding_model, embedding_dim, analyzed_at)"
+            " VALUES (%s, 'c', 'e', 's', %s::halfvec, %s, %s, now())",
+            (uri, _vector(values), MODEL, DIMENSION)
+        )
+    cursor.execute("INSERT INTO unpleasant_feedback (user_did, post_uri, reported_at) VALUES (%s, 'at://reported', now())", (USER_DID,))
+    # インデックスが使われた場合でも漏れが出ないことを確かめる
+    cursor.execute("SET LOCAL hnsw.ef_search = 10")
+    cursor.execute("SET LOCAL enable_seqscan = off")
+
+    page = [uri for uri, _ in rows[1:]]
+    query = database.SIMILAR_POST_URIS_QUERY.format(uris='%s', user_did='%s', threshold='%s')
+    cursor.execute(query, (page, USER_DID, 0.9))
+    found = {row[0] for row in cursor.fetchall()}
+
+    assert found == {f'at://similar/{i}' for i in range(N_CANDIDATES)}